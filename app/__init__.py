@@ -1,3 +1,4 @@
+from functools import cached_property
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
@@ -18,6 +19,31 @@ def get_locale():
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
 
 
+def get_task_queue(task_name):
+    """Return the queue that jobs running ``task_name`` are routed to."""
+    config = current_app.config
+    return current_app.task_queues[
+        config['TASK_ROUTES'].get(task_name, config['TASK_QUEUES'][0])]
+
+
+class Microblog(Flask):
+    """Flask application that creates its service clients on first use."""
+    @cached_property
+    def elasticsearch(self):
+        if not self.config['ELASTICSEARCH_URL']:
+            return None
+        return Elasticsearch([self.config['ELASTICSEARCH_URL']])
+
+    @cached_property
+    def redis(self):
+        return Redis.from_url(self.config['REDIS_URL'])
+
+    @cached_property
+    def task_queues(self):
+        return {name: rq.Queue(f'microblog-{name}', connection=self.redis)
+                for name in self.config['TASK_QUEUES']}
+
+
 db = SQLAlchemy()
 migrate = Migrate()
 login = LoginManager()
@@ -29,7 +55,7 @@ babel = Babel()
 
 
 def create_app(config_class=Config):
-    app = Flask(__name__)
+    app = Microblog(__name__)
     app.config.from_object(config_class)
 
     db.init_app(app)
@@ -38,10 +64,6 @@ def create_app(config_class=Config):
     mail.init_app(app)
     moment.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
-        if app.config['ELASTICSEARCH_URL'] else None
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -1,6 +1,6 @@
 import sqlalchemy as sa
 from flask import request, url_for, abort
-from app import db
+from app import db, usernames
 from app.models import User
 from app.api import bp
 from app.api.auth import token_auth
@@ -18,8 +18,9 @@ def get_user(id):
 def get_users():
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
+    cursor = request.args.get('cursor')
     return User.to_collection_dict(sa.select(User), page, per_page,
-                                   'api.get_users')
+                                   'api.get_users', cursor=cursor)
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
@@ -28,8 +29,9 @@ def get_followers(id):
     user = db.get_or_404(User, id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
+    cursor = request.args.get('cursor')
     return User.to_collection_dict(user.followers.select(), page, per_page,
-                                   'api.get_followers', id=id)
+                                   'api.get_followers', cursor=cursor, id=id)
 
 
 @bp.route('/users/<int:id>/following', methods=['GET'])
@@ -38,8 +40,9 @@ def get_following(id):
     user = db.get_or_404(User, id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
+    cursor = request.args.get('cursor')
     return User.to_collection_dict(user.following.select(), page, per_page,
-                                   'api.get_following', id=id)
+                                   'api.get_following', cursor=cursor, id=id)
 
 
 @bp.route('/users', methods=['POST'])
@@ -57,6 +60,7 @@ def create_user():
     user.from_dict(data, new_user=True)
     db.session.add(user)
     db.session.commit()
+    usernames.add(user.username)
     return user.to_dict(), 201, {'Location': url_for('api.get_user',
                                                      id=user.id)}
 
@@ -76,6 +80,10 @@ def update_user(id):
         db.session.scalar(sa.select(User).where(
             User.email == data['email'])):
         return bad_request('please use a different email address')
+    old_username, old_email = user.username, user.email
     user.from_dict(data, new_user=False)
     db.session.commit()
+    usernames.rename(old_username, user.username)
+    if (user.username, user.email) != (old_username, old_email):
+        user.reindex_posts()
     return user.to_dict()
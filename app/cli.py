@@ -1,6 +1,16 @@
+from concurrent.futures import ProcessPoolExecutor
 import os
-from flask import Blueprint
+import time
+from flask import Blueprint, current_app
 import click
+import rq
+import sqlalchemy as sa
+from app import db, exports
+from app.language import detect_many
+from app.models import User, Post
+from app.search import get_backend
+from app.translate import get_cache_stats, create_stub_app
+from app.worker import WorkerPool, parse_workers
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
@@ -38,3 +48,207 @@ def compile():
     """Compile all languages."""
     if os.system('pybabel compile -d app/translations'):
         raise RuntimeError('compile command failed')
+
+
+@translate.command('stub-server')
+@click.option('--port', default=5005, help='Port to listen on.')
+@click.option('--delay', default=0.0, help='Seconds to wait per request.')
+def stub_server(port, delay):
+    """Run a local stand-in for the Translator API."""
+    create_stub_app(delay).run(port=port)
+
+
+@translate.command('cache-stats')
+def cache_stats():
+    """Show hits and misses of the translation cache."""
+    stats = get_cache_stats()
+    lookups = sum(stats.values())
+    for name, value in stats.items():
+        click.echo(f'{name}: {value}')
+    if lookups:
+        click.echo('hit rate: {:.1%}'.format(1 - stats['misses'] / lookups))
+
+
+@bp.cli.group()
+def language():
+    """Post language detection commands."""
+    pass
+
+
+@language.command()
+@click.option('--chunk-size', default=500, help='Posts per worker task.')
+@click.option('--workers', default=os.cpu_count(),
+              help='Number of detection processes.')
+def backfill(chunk_size, workers):
+    """Detect the language of posts that do not have one."""
+    done = 0
+    last_id = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            rows = [tuple(row) for row in db.session.execute(
+                sa.select(Post.id, Post.body).where(
+                    Post.language.is_(None), Post.id > last_id).order_by(
+                        Post.id).limit(chunk_size * workers))]
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            chunks = [rows[i:i + chunk_size]
+                      for i in range(0, len(rows), chunk_size)]
+            db.session.execute(sa.update(Post), [
+                {'id': id, 'language': detected}
+                for result in executor.map(detect_many, chunks)
+                for id, detected in result])
+            db.session.commit()
+            done += len(rows)
+            click.echo(f'{done} posts updated')
+
+
+@bp.cli.group('exports')
+def exports_group():
+    """Post export commands."""
+    pass
+
+
+@exports_group.command()
+def purge():
+    """Delete expired post exports."""
+    click.echo(f'{exports.purge()} export(s) deleted.')
+
+
+@bp.cli.group()
+def worker():
+    """Background task worker commands."""
+    pass
+
+
+@worker.command()
+@click.option('--workers', default=None,
+              help='Workers per queue, for example interactive=2,bulk=1.')
+def pool(workers):
+    """Run a pool of task workers for all the queues."""
+    spec = parse_workers(workers or current_app.config['TASK_WORKERS'])
+    unknown = set(spec) - set(current_app.config['TASK_QUEUES'])
+    if unknown:
+        raise click.ClickException('Unknown queue(s): ' +
+                                   ', '.join(sorted(unknown)))
+    WorkerPool(current_app.config['REDIS_URL'], spec,
+               logger=current_app.logger).run()
+
+
+@worker.command()
+@click.option('--bulk', default=20, help='Number of slow bulk jobs.')
+@click.option('--bulk-duration', default=2.0,
+              help='Seconds each bulk job takes.')
+@click.option('--interactive', default=50, type=click.IntRange(1),
+              help='Number of fast interactive jobs.')
+@click.option('--single-queue', is_flag=True,
+              help='Put all jobs in the bulk queue, for comparison.')
+@click.option('--timeout', default=300, help='Seconds to wait for jobs.')
+def benchmark(bulk, bulk_duration, interactive, single_queue, timeout):
+    """Measure queue latency of interactive jobs under bulk load."""
+    queues = current_app.task_queues
+    bulk_queue = queues['bulk']
+    interactive_queue = bulk_queue if single_queue else \
+        queues[current_app.config['TASK_QUEUES'][0]]
+    for _ in range(bulk):
+        bulk_queue.enqueue('app.worker.sleep_task', bulk_duration)
+    jobs = []
+    for _ in range(interactive):
+        jobs.append(interactive_queue.enqueue('app.worker.sleep_task', 0))
+        time.sleep(0.05)
+    deadline = time.time() + timeout
+    while True:
+        jobs = rq.job.Job.fetch_many([job.id for job in jobs],
+                                     connection=current_app.redis)
+        if all(job.is_finished or job.is_failed for job in jobs):
+            break
+        if time.time() > deadline:
+            raise click.ClickException('Timed out waiting for jobs.')
+        time.sleep(0.5)
+    latencies = sorted((job.started_at - job.enqueued_at).total_seconds()
+                       for job in jobs)
+    click.echo('interactive queue latency: p50 {:.3f}s, p95 {:.3f}s, '
+               'max {:.3f}s'.format(latencies[len(latencies) // 2],
+                                    latencies[int(len(latencies) * 0.95)],
+                                    latencies[-1]))
+
+
+@bp.cli.group()
+def timeline():
+    """Home timeline commands."""
+    pass
+
+
+@timeline.command()
+@click.option('--user', 'username', help='Only rebuild this user.')
+def rebuild(username):
+    """Rebuild materialized home timelines."""
+    query = sa.select(User)
+    if username:
+        query = query.where(User.username == username)
+    count = 0
+    for user in db.session.scalars(query):
+        user.rebuild_timeline()
+        db.session.commit()
+        count += 1
+    click.echo(f'Rebuilt {count} timeline(s).')
+
+
+@bp.cli.group()
+def counters():
+    """Denormalized user counter commands."""
+    pass
+
+
+@counters.command()
+@click.option('--repair', is_flag=True, help='Fix the counters that drifted.')
+def check(repair):
+    """Compare user counters against the real counts."""
+    expected = User.counter_queries()
+    query = sa.select(User.id, User.username).where(sa.or_(*[
+        getattr(User, name) != value for name, value in expected.items()]))
+    drifted = db.session.execute(query).all()
+    for user_id, username in drifted:
+        click.echo(f'Counters for {username} (id {user_id}) have drifted.')
+    if drifted and repair:
+        db.session.execute(
+            sa.update(User).where(User.id.in_([id for id, _ in drifted]))
+            .values(**expected).execution_options(synchronize_session=False))
+        db.session.commit()
+        click.echo(f'Repaired {len(drifted)} user(s).')
+    elif not drifted:
+        click.echo('All counters are consistent.')
+
+
+@bp.cli.group()
+def search():
+    """Search index commands."""
+    pass
+
+
+@search.command()
+@click.option('--chunk-size', default=1000, help='Rows per id range.')
+@click.option('--workers', default=4, help='Number of indexing threads.')
+@click.option('--resume', is_flag=True,
+              help='Continue an interrupted reindex.')
+def reindex(chunk_size, workers, resume):
+    """Rebuild the posts search index."""
+    if get_backend() is None:
+        raise click.ClickException('Search is not configured.')
+    total = db.session.scalar(sa.select(sa.func.count(Post.id)))
+    start = time.time()
+    done = 0
+
+    def progress(count):
+        nonlocal done
+        done += count
+        elapsed = time.time() - start
+        click.echo('{}/{} posts indexed ({:.0f} posts/s)'.format(
+            done, total, done / elapsed if elapsed else 0))
+
+    try:
+        index = Post.reindex(chunk_size=chunk_size, workers=workers,
+                             resume=resume, callback=progress)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Search alias {Post.__tablename__} now points to {index}.')
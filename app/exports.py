@@ -0,0 +1,37 @@
+import os
+import time
+from flask import current_app
+
+
+def export_path(task_id):
+    return os.path.join(current_app.config['EXPORTS_DIR'],
+                        f'{task_id}.ndjson.gz')
+
+
+def is_expired(path):
+    return time.time() - os.path.getmtime(path) > \
+        current_app.config['EXPORT_TTL']
+
+
+def remove(task_id):
+    try:
+        os.remove(export_path(task_id))
+    except FileNotFoundError:
+        pass
+
+
+def purge():
+    """Delete expired exports and leftovers of failed ones.
+
+    Returns the number of files that were removed.
+    """
+    directory = current_app.config['EXPORTS_DIR']
+    if not os.path.isdir(directory):
+        return 0
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if is_expired(path):
+            os.remove(path)
+            removed += 1
+    return removed
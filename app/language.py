@@ -0,0 +1,38 @@
+from langdetect import DetectorFactory, LangDetectException, detect
+from langdetect.detector_factory import init_factory
+import redis
+from app import db, get_task_queue
+
+# langdetect is non-deterministic unless seeded
+DetectorFactory.seed = 0
+
+
+def preload():
+    """Load the language profiles, which langdetect does on first use."""
+    init_factory()
+
+
+def detect_language(text):
+    try:
+        return detect(text)
+    except LangDetectException:
+        return ''
+
+
+def detect_many(rows):
+    """Detect the language of (id, text) pairs, for use in a process pool."""
+    return [(id, detect_language(text)) for id, text in rows]
+
+
+def submit(post):
+    """Fill in the language of a committed post in the background.
+
+    When the task queue is not available the language is detected
+    right away instead.
+    """
+    try:
+        get_task_queue('detect_post_language').enqueue(
+            'app.tasks.detect_post_language', post.id)
+    except redis.exceptions.RedisError:
+        post.language = detect_language(post.body)
+        db.session.commit()
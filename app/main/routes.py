@@ -1,23 +1,27 @@
 from datetime import datetime, timezone
+import json
+import os
+from time import monotonic
 from flask import render_template, flash, redirect, url_for, request, g, \
-    current_app
+    current_app, Response, abort, send_file
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
 import sqlalchemy as sa
-from langdetect import detect, LangDetectException
-from app import db
+import redis
+from app import db, exports, language, presence, usernames
+from app.api.errors import bad_request
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, \
     MessageForm
-from app.models import User, Post, Message, Notification
-from app.translate import translate
+from app.models import User, Post, Message, Task, timeline
+from app.pagination import keyset_paginate
+from app.translate import translate, translate_many
 from app.main import bp
 
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        presence.touch(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
@@ -28,23 +32,25 @@ def before_request():
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
-        post = Post(body=form.post.data, author=current_user,
-                    language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
         db.session.commit()
+        language.submit(post)
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) \
+    cursor = request.args.get('cursor')
+    if current_user.has_timeline():
+        query = current_user.timeline_posts()
+        columns = (timeline.c.timestamp, timeline.c.post_id)
+    else:
+        query = current_user.following_posts()
+        columns = (Post.timestamp, Post.id)
+    posts = keyset_paginate(query, columns, cursor,
+                            current_app.config['POSTS_PER_PAGE'],
+                            key=lambda post: (post.timestamp, post.id))
+    next_url = url_for('main.index', cursor=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
+    prev_url = url_for('main.index', cursor=posts.prev_cursor) \
         if posts.has_prev else None
     return render_template('index.html', title=_('Home'), form=form,
                            posts=posts.items, next_url=next_url,
@@ -54,14 +60,12 @@ def index():
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.explore', page=posts.next_num) \
+    cursor = request.args.get('cursor')
+    posts = keyset_paginate(sa.select(Post), (Post.timestamp, Post.id),
+                            cursor, current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for('main.explore', cursor=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
+    prev_url = url_for('main.explore', cursor=posts.prev_cursor) \
         if posts.has_prev else None
     return render_template('index.html', title=_('Explore'),
                            posts=posts.items, next_url=next_url,
@@ -72,15 +76,13 @@ def explore():
 @login_required
 def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get('page', 1, type=int)
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
+    cursor = request.args.get('cursor')
+    posts = keyset_paginate(user.posts.select(), (Post.timestamp, Post.id),
+                            cursor, current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.user', username=user.username,
-                       page=posts.next_num) if posts.has_next else None
+                       cursor=posts.next_cursor) if posts.has_next else None
     prev_url = url_for('main.user', username=user.username,
-                       page=posts.prev_num) if posts.has_prev else None
+                       cursor=posts.prev_cursor) if posts.has_prev else None
     form = EmptyForm()
     return render_template('user.html', user=user, posts=posts.items,
                            next_url=next_url, prev_url=prev_url, form=form)
@@ -94,14 +96,24 @@ def user_popup(username):
     return render_template('user_popup.html', user=user, form=form)
 
 
+@bp.route('/users/autocomplete')
+@login_required
+def autocomplete_users():
+    return usernames.complete(request.args.get('q', ''))
+
+
 @bp.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
+        old_username = current_user.username
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
         db.session.commit()
+        usernames.rename(old_username, current_user.username)
+        if current_user.username != old_username:
+            current_user.reindex_posts()
         flash(_('Your changes have been saved.'))
         return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
@@ -162,6 +174,31 @@ def translate_text():
                               data['dest_language'])}
 
 
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_posts():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or \
+            not isinstance(data.get('dest_language'), str) or \
+            not isinstance(data.get('post_ids'), list) or \
+            not all(isinstance(id, int) for id in data['post_ids']):
+        return bad_request('must include post_ids and dest_language fields')
+    dest_language = data['dest_language']
+    post_ids = data['post_ids'][:current_app.config['TRANSLATION_BATCH_SIZE']]
+    by_language = {}
+    for post in db.session.scalars(sa.select(Post).where(
+            Post.id.in_(post_ids))):
+        if post.language and post.language != dest_language:
+            by_language.setdefault(post.language, []).append(post)
+    translations = {}
+    for source_language, group in by_language.items():
+        texts = translate_many([post.body for post in group],
+                               source_language, dest_language)
+        translations.update(
+            (post.id, text) for post, text in zip(group, texts))
+    return {'translations': translations}
+
+
 @bp.route('/search')
 @login_required
 def search():
@@ -187,8 +224,11 @@ def send_message(recipient):
         msg = Message(author=current_user, recipient=user,
                       body=form.message.data)
         db.session.add(msg)
+        db.session.commit()
+        # counted only once the message is stored, so that a failed
+        # commit does not leave the counter too high
         user.add_notification('unread_message_count',
-                              user.unread_message_count())
+                              user.increment_unread_message_count())
         db.session.commit()
         flash(_('Your message has been sent.'))
         return redirect(url_for('main.user', username=recipient))
@@ -200,17 +240,17 @@ def send_message(recipient):
 @login_required
 def messages():
     current_user.last_message_read_time = datetime.now(timezone.utc)
+    # reset before the commit, so that a message sent in between is counted
+    current_user.reset_unread_message_count()
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    query = current_user.messages_received.select().order_by(
-        Message.timestamp.desc())
-    messages = db.paginate(query, page=page,
-                           per_page=current_app.config['POSTS_PER_PAGE'],
-                           error_out=False)
-    next_url = url_for('main.messages', page=messages.next_num) \
+    cursor = request.args.get('cursor')
+    messages = keyset_paginate(current_user.messages_received.select(),
+                               (Message.timestamp, Message.id), cursor,
+                               current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for('main.messages', cursor=messages.next_cursor) \
         if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
+    prev_url = url_for('main.messages', cursor=messages.prev_cursor) \
         if messages.has_prev else None
     return render_template('messages.html', messages=messages.items,
                            next_url=next_url, prev_url=prev_url)
@@ -222,20 +262,74 @@ def export_posts():
     if current_user.get_task_in_progress('export_posts'):
         flash(_('An export task is currently in progress'))
     else:
-        current_user.launch_task('export_posts', _('Exporting posts...'))
+        current_user.launch_task('export_posts', _('Exporting posts...'),
+                                 request.url_root)
         db.session.commit()
     return redirect(url_for('main.user', username=current_user.username))
 
 
+@bp.route('/exports/<task_id>')
+@login_required
+def download_export(task_id):
+    task = db.get_or_404(Task, task_id)
+    if task.user_id != current_user.id or task.name != 'export_posts':
+        abort(404)
+    path = exports.export_path(task.id)
+    if not os.path.exists(path) or exports.is_expired(path):
+        abort(404)
+    # conditional responses handle If-None-Match and Range requests
+    return send_file(path, mimetype='application/gzip', as_attachment=True,
+                     download_name='posts.ndjson.gz', conditional=True,
+                     etag=True, max_age=0)
+
+
 @bp.route('/notifications')
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
-    query = current_user.notifications.select().where(
-        Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    notifications = db.session.scalars(query)
-    return [{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications]
+    return current_user.get_notifications(since)
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    try:
+        since = float(request.headers.get('Last-Event-ID') or
+                      request.args.get('since') or 0.0)
+    except ValueError:
+        since = 0.0
+    pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(current_user.notification_channel())
+    except redis.exceptions.RedisError:
+        pubsub.close()
+        return '', 204
+
+    # subscribe before reading the backlog so that nothing is missed
+    backlog = [json.dumps(n) for n in current_user.get_notifications(since)]
+    timeout = current_app.config['NOTIFICATION_STREAM_TIMEOUT']
+    keepalive = current_app.config['NOTIFICATION_STREAM_KEEPALIVE']
+
+    def event(payload):
+        return 'id: {}\ndata: {}\n\n'.format(
+            json.loads(payload)['timestamp'], payload)
+
+    def stream():
+        try:
+            for payload in backlog:
+                yield event(payload)
+            deadline = monotonic() + timeout
+            while monotonic() < deadline:
+                message = pubsub.get_message(timeout=keepalive)
+                if message is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield event(message['data'].decode('utf-8'))
+        except redis.exceptions.RedisError:
+            pass
+        finally:
+            pubsub.close()
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
@@ -1,33 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone, timedelta
 from hashlib import md5
 import json
+import os
 import secrets
 from time import time
 from typing import Optional
 import sqlalchemy as sa
 import sqlalchemy.orm as so
-from flask import current_app, url_for
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from flask import current_app, url_for, g, has_request_context, \
+    before_render_template, template_rendered
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 import redis
 import rq
-from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app import db, login, presence, get_task_queue
+from app.pagination import keyset_paginate
+from app.search import query_index, index_action, delete_action, \
+    submit_actions, bulk_index, create_index, start_reindex, swap_alias, \
+    add_fts_table
+
+
+INCR_IF_EXISTS = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('incr', KEYS[1])
+end
+"""
 
 
 class SearchableMixin:
     @classmethod
     def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        ids, total, sources = query_index(cls.__tablename__, expression,
+                                          page, per_page, cls.__searchable__)
         if total == 0:
             return [], 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        query = sa.select(cls).where(cls.id.in_(ids)).order_by(
-            db.case(*when, value=cls.id))
-        return db.session.scalars(query), total
+        hits = {id: cls.from_search_source(id, source)
+                for id, source in zip(ids, sources) if source is not None}
+        missing = [id for id in ids if hits.get(id) is None]
+        if missing:
+            query = sa.select(cls).where(cls.id.in_(missing))
+            hits.update((obj.id, obj) for obj in db.session.scalars(query))
+        return [hits[id] for id in ids if hits.get(id) is not None], total
+
+    def search_source(self):
+        """Fields stored in the index to render a hit without the database."""
+        return None
+
+    @classmethod
+    def from_search_source(cls, id, source):
+        """Object to render a hit from its stored fields, or None to load
+        the row from the database."""
+        return None
+
+    @classmethod
+    def search_loader_options(cls):
+        """Loader options for the rows read when rebuilding the index."""
+        return [so.lazyload('*')]
 
     @classmethod
     def before_commit(cls, session):
@@ -39,34 +70,134 @@ class SearchableMixin:
 
     @classmethod
     def after_commit(cls, session):
+        actions = []
         for obj in session._changes['add']:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
+                actions.append(index_action(obj.__tablename__, obj))
         for obj in session._changes['update']:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
+                actions.append(index_action(obj.__tablename__, obj))
         for obj in session._changes['delete']:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+                actions.append(delete_action(obj.__tablename__, obj))
         session._changes = None
+        submit_actions(actions)
 
     @classmethod
-    def reindex(cls):
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
+    def reindex(cls, chunk_size=1000, workers=4, resume=False,
+                callback=None):
+        """Rebuild the search index in parallel id ranges and swap the alias,
+        recording finished ranges so an interrupted run can be resumed."""
+        alias = cls.__tablename__
+        state_file = os.path.join(current_app.instance_path,
+                                  f'reindex-{alias}.json')
+        state = None
+        if resume and os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            if state.get('chunk_size') != chunk_size:
+                raise ValueError('The interrupted reindex used a chunk size '
+                                 'of {}.'.format(state.get('chunk_size')))
+        if state is None:
+            state = {'index': create_index(alias), 'chunk_size': chunk_size,
+                     'done': []}
+        else:
+            create_index(alias, state['index'])
+        start_reindex(alias, state['index'])
+        low, high = db.session.execute(
+            sa.select(sa.func.min(cls.id), sa.func.max(cls.id))).one()
+        done = set(state['done'])
+        chunks = [] if low is None else [
+            (start, start + chunk_size - 1)
+            for start in range(low, high + 1, chunk_size)
+            if start not in done]
+        app = current_app._get_current_object()
+
+        def index_chunk(chunk):
+            with app.app_context():
+                query = sa.select(cls).where(
+                    cls.id.between(*chunk)).options(
+                        *cls.search_loader_options())
+                actions = [index_action(state['index'], obj)
+                           for obj in db.session.scalars(
+                               query.execution_options(yield_per=500))]
+                failed = bulk_index(actions, refresh=False)
+                if failed:
+                    raise RuntimeError(
+                        '{} document(s) in ids {}-{} could not be '
+                        'indexed'.format(len(failed), *chunk))
+                return chunk, len(actions)
+
+        os.makedirs(current_app.instance_path, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(index_chunk, chunk)
+                       for chunk in chunks]
+            for future in as_completed(futures):
+                chunk, count = future.result()
+                state['done'].append(chunk[0])
+                with open(state_file, 'w') as f:
+                    json.dump(state, f)
+                if callback:
+                    callback(count)
+        swap_alias(alias, state['index'])
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        return state['index']
 
 
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 
 
+class LazyLoadError(Exception):
+    pass
+
+
+@before_render_template.connect
+def start_template_render(sender, template, context, **extra):
+    g.rendering_template = template.name or '<string>'
+
+
+@template_rendered.connect
+def end_template_render(sender, template, context, **extra):
+    g.rendering_template = None
+
+
+@db.event.listens_for(db.session, 'do_orm_execute')
+def check_lazy_load(orm_execute_state):
+    if not orm_execute_state.is_select or \
+            orm_execute_state.lazy_loaded_from is None or \
+            not has_request_context() or \
+            not current_app.config['RAISE_ON_LAZY_LOAD']:
+        return
+    if g.get('rendering_template'):
+        raise LazyLoadError('lazy load of {} while rendering {}'.format(
+            orm_execute_state.lazy_loaded_from.object,
+            g.rendering_template))
+
+
+def url_builder(endpoint, **kwargs):
+    marker = str(2 ** 31 - 1)
+    prefix, suffix = url_for(endpoint, id=int(marker), **kwargs).split(
+        marker, 1)
+    return lambda id: f'{prefix}{id}{suffix}'
+
+
 class PaginatedAPIMixin(object):
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    @classmethod
+    def to_dict_bulk(cls, items):
+        return [item.to_dict() for item in items]
+
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, cursor=None,
+                           **kwargs):
+        if cursor is not None:
+            return cls.to_cursor_collection_dict(query, cursor, per_page,
+                                                 endpoint, **kwargs)
         resources = db.paginate(query, page=page, per_page=per_page,
                                 error_out=False)
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': cls.to_dict_bulk(resources.items),
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -84,6 +215,30 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    @classmethod
+    def to_cursor_collection_dict(cls, query, cursor, per_page, endpoint,
+                                  **kwargs):
+        resources = keyset_paginate(query, (cls.id,), cursor, per_page)
+        data = {
+            'items': cls.to_dict_bulk(resources.items),
+            '_meta': {
+                'per_page': per_page,
+                'next_cursor': resources.next_cursor,
+                'prev_cursor': resources.prev_cursor
+            },
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page,
+                                **kwargs),
+                'next': url_for(endpoint, cursor=resources.next_cursor,
+                                per_page=per_page, **kwargs)
+                if resources.has_next else None,
+                'prev': url_for(endpoint, cursor=resources.prev_cursor,
+                                per_page=per_page, **kwargs)
+                if resources.has_prev else None
+            }
+        }
+        return data
+
 
 followers = sa.Table(
     'followers',
@@ -95,6 +250,22 @@ followers = sa.Table(
 )
 
 
+timeline = sa.Table(
+    'timeline',
+    db.metadata,
+    sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'),
+              primary_key=True),
+    sa.Column('post_id', sa.Integer, sa.ForeignKey('post.id'),
+              primary_key=True),
+    sa.Column('timestamp', sa.DateTime, nullable=False),
+    sa.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp')
+)
+
+
+def avatar_url(digest, size):
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
+
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     username: so.Mapped[str] = so.mapped_column(sa.String(64), index=True,
@@ -109,6 +280,12 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     token: so.Mapped[Optional[str]] = so.mapped_column(
         sa.String(32), index=True, unique=True)
     token_expiration: so.Mapped[Optional[datetime]]
+    num_posts: so.Mapped[int] = so.mapped_column(default=0,
+                                                 server_default='0')
+    num_followers: so.Mapped[int] = so.mapped_column(default=0,
+                                                     server_default='0')
+    num_following: so.Mapped[int] = so.mapped_column(default=0,
+                                                     server_default='0')
 
     posts: so.WriteOnlyMapped['Post'] = so.relationship(
         back_populates='author')
@@ -137,31 +314,49 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def get_last_seen(self):
+        return presence.latest(self.last_seen,
+                               presence.get_buffered(self.id))
+
+    def avatar_hash(self):
+        return md5(self.email.lower().encode('utf-8')).hexdigest()
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return avatar_url(self.avatar_hash(), size)
 
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            self._update_follow_counts(user, 1)
+            db.session.execute(timeline.insert().from_select(
+                ['user_id', 'post_id', 'timestamp'],
+                sa.select(sa.literal(self.id), Post.id, Post.timestamp)
+                .where(Post.user_id == user.id)))
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self._update_follow_counts(user, -1)
+            db.session.execute(timeline.delete().where(
+                timeline.c.user_id == self.id,
+                timeline.c.post_id.in_(
+                    sa.select(Post.id).where(Post.user_id == user.id))))
+
+    def _update_follow_counts(self, user, delta):
+        db.session.execute(sa.update(User).where(User.id == self.id).values(
+            num_following=User.num_following + delta))
+        db.session.execute(sa.update(User).where(User.id == user.id).values(
+            num_followers=User.num_followers + delta))
 
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
 
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery())
-        return db.session.scalar(query)
+        return self.num_followers
 
     def following_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery())
-        return db.session.scalar(query)
+        return self.num_following
 
     def following_posts(self):
         Author = so.aliased(User)
@@ -178,6 +373,32 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             .order_by(Post.timestamp.desc())
         )
 
+    def has_timeline(self):
+        query = sa.select(timeline.c.post_id).where(
+            timeline.c.user_id == self.id).limit(1)
+        return db.session.scalar(query) is not None
+
+    def timeline_posts(self):
+        return (
+            sa.select(Post)
+            .join(timeline, timeline.c.post_id == Post.id)
+            .where(timeline.c.user_id == self.id)
+            .order_by(timeline.c.timestamp.desc())
+        )
+
+    def rebuild_timeline(self):
+        db.session.execute(timeline.delete().where(
+            timeline.c.user_id == self.id))
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            sa.select(sa.literal(self.id), Post.id, Post.timestamp)
+            .where(sa.or_(
+                Post.user_id == self.id,
+                Post.user_id.in_(
+                    sa.select(followers.c.followed_id)
+                    .where(followers.c.follower_id == self.id)),
+            ))))
+
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
             {'reset_password': self.id, 'exp': time() + expires_in},
@@ -192,23 +413,109 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             return
         return db.session.get(User, id)
 
+    def _unread_message_count_key(self):
+        return f'unread-messages:{self.id}'
+
     def unread_message_count(self):
+        key = self._unread_message_count_key()
+        try:
+            count = current_app.redis.get(key)
+        except redis.exceptions.RedisError:
+            key = count = None
+        if count is not None:
+            return int(count)
         last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
         query = sa.select(Message).where(Message.recipient == self,
                                          Message.timestamp > last_read_time)
-        return db.session.scalar(sa.select(sa.func.count()).select_from(
+        count = db.session.scalar(sa.select(sa.func.count()).select_from(
             query.subquery()))
+        if key is not None:
+            try:
+                current_app.redis.set(
+                    key, count, nx=True,
+                    ex=current_app.config['UNREAD_MESSAGE_COUNT_TTL'])
+            except redis.exceptions.RedisError:
+                pass
+        return count
+
+    def increment_unread_message_count(self):
+        try:
+            count = current_app.redis.eval(
+                INCR_IF_EXISTS, 1, self._unread_message_count_key())
+        except redis.exceptions.RedisError:
+            count = None
+        if count is None:
+            return self.unread_message_count()
+        return int(count)
+
+    def reset_unread_message_count(self):
+        try:
+            current_app.redis.set(
+                self._unread_message_count_key(), 0,
+                ex=current_app.config['UNREAD_MESSAGE_COUNT_TTL'])
+        except redis.exceptions.RedisError:
+            pass
+
+    def notification_channel(self):
+        return Notification.channel(self.id)
+
+    def _notifications_key(self):
+        return Notification.latest_key(self.id)
+
+    def add_notification(self, name, data, pipeline=None):
+        # sent to Redis once the session commits, so that changes that are
+        # rolled back are never announced; when a pipeline is given it is
+        # added to it right away instead, the caller executes it and
+        # handles Redis errors by calling this method again without one
+        notification = {'name': name, 'data': data, 'timestamp': time()}
+        if name not in Notification.LATEST_VALUE_NAMES:
+            Notification.upsert(self.id, name, data,
+                                notification['timestamp'])
+        if pipeline is None:
+            db.session.info.setdefault('notifications', []).append(
+                (self.id, notification))
+        else:
+            Notification.send(pipeline, self.id, notification)
+        return notification
+
+    def reindex_posts(self):
+        """Update the search documents of the user's posts.
+
+        Documents store the author's username and avatar hash when
+        SEARCH_STORE_SOURCE is set, so they must be rewritten after
+        either of them changes.
+        """
+        if not current_app.config['SEARCH_STORE_SOURCE']:
+            return
+        query = self.posts.select().options(
+            *Post.search_loader_options()).execution_options(yield_per=500)
+        for posts in db.session.scalars(query).partitions():
+            submit_actions([index_action(Post.__tablename__, post)
+                            for post in posts])
 
-    def add_notification(self, name, data):
-        db.session.execute(self.notifications.delete().where(
-            Notification.name == name))
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+    def get_notifications(self, since=0.0):
+        try:
+            cached = current_app.redis.hgetall(self._notifications_key())
+        except redis.exceptions.RedisError:
+            cached = {}
+        latest = {}
+        for name, value in cached.items():
+            value = json.loads(value)
+            latest[name.decode('utf-8')] = {
+                'name': name.decode('utf-8'), 'data': value['data'],
+                'timestamp': value['timestamp']}
+        query = self.notifications.select().where(
+            Notification.timestamp > since)
+        for n in db.session.scalars(query):
+            if n.name not in latest or \
+                    latest[n.name]['timestamp'] < n.timestamp:
+                latest[n.name] = n.to_dict()
+        return sorted([n for n in latest.values() if n['timestamp'] > since],
+                      key=lambda n: n['timestamp'])
 
     def launch_task(self, name, description, *args, **kwargs):
-        rq_job = current_app.task_queue.enqueue(f'app.tasks.{name}', self.id,
-                                                *args, **kwargs)
+        rq_job = get_task_queue(name).enqueue(f'app.tasks.{name}', self.id,
+                                              *args, **kwargs)
         task = Task(id=rq_job.get_id(), name=name, description=description,
                     user=self)
         db.session.add(task)
@@ -218,36 +525,66 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         query = self.tasks.select().where(Task.complete == False)
         return db.session.scalars(query)
 
+    def get_tasks_progress(self):
+        cache = g.setdefault('tasks_progress', {})
+        if self.id not in cache:
+            tasks = self.get_tasks_in_progress().all()
+            cache[self.id] = list(zip(tasks, Task.get_progress_many(tasks)))
+        return cache[self.id]
+
     def get_task_in_progress(self, name):
         query = self.tasks.select().where(Task.name == name,
                                           Task.complete == False)
         return db.session.scalar(query)
 
     def posts_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.posts.select().subquery())
-        return db.session.scalar(query)
+        return self.num_posts
+
+    @staticmethod
+    def counter_queries():
+        return {
+            'num_posts': sa.select(sa.func.count(Post.id)).where(
+                Post.user_id == User.id).scalar_subquery(),
+            'num_followers': sa.select(sa.func.count()).select_from(
+                followers).where(
+                    followers.c.followed_id == User.id).scalar_subquery(),
+            'num_following': sa.select(sa.func.count()).select_from(
+                followers).where(
+                    followers.c.follower_id == User.id).scalar_subquery(),
+        }
 
     def to_dict(self, include_email=False):
-        data = {
-            'id': self.id,
-            'username': self.username,
-            'last_seen': self.last_seen.replace(
-                tzinfo=timezone.utc).isoformat(),
-            'about_me': self.about_me,
-            'post_count': self.posts_count(),
-            'follower_count': self.followers_count(),
-            'following_count': self.following_count(),
-            '_links': {
-                'self': url_for('api.get_user', id=self.id),
-                'followers': url_for('api.get_followers', id=self.id),
-                'following': url_for('api.get_following', id=self.id),
-                'avatar': self.avatar(128)
+        return User.to_dict_bulk([self], include_email=include_email)[0]
+
+    @classmethod
+    def to_dict_bulk(cls, users, include_email=False):
+        self_url = url_builder('api.get_user')
+        followers_url = url_builder('api.get_followers')
+        following_url = url_builder('api.get_following')
+        buffered = presence.get_buffered_many([user.id for user in users])
+        items = []
+        for user in users:
+            last_seen = presence.latest(user.last_seen, buffered.get(user.id))
+            data = {
+                'id': user.id,
+                'username': user.username,
+                'last_seen': last_seen.replace(
+                    tzinfo=timezone.utc).isoformat(),
+                'about_me': user.about_me,
+                'post_count': user.num_posts,
+                'follower_count': user.num_followers,
+                'following_count': user.num_following,
+                '_links': {
+                    'self': self_url(user.id),
+                    'followers': followers_url(user.id),
+                    'following': following_url(user.id),
+                    'avatar': user.avatar(128)
+                }
             }
-        }
-        if include_email:
-            data['email'] = self.email
-        return data
+            if include_email:
+                data['email'] = user.email
+            items.append(data)
+        return items
 
     def from_dict(self, data, new_user=False):
         for field in ['username', 'email', 'about_me']:
@@ -294,11 +631,74 @@ class Post(SearchableMixin, db.Model):
                                                index=True)
     language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
 
-    author: so.Mapped[User] = so.relationship(back_populates='posts')
+    author: so.Mapped[User] = so.relationship(back_populates='posts',
+                                              lazy='selectin')
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    def search_source(self):
+        return {'body': self.body,
+                'timestamp': self.timestamp.isoformat(),
+                'language': self.language,
+                'author': {'username': self.author.username,
+                           'avatar_hash': self.author.avatar_hash()}}
+
+    @classmethod
+    def from_search_source(cls, id, source):
+        return PostHit(id, source)
+
+    @classmethod
+    def search_loader_options(cls):
+        return [so.joinedload(Post.author), so.lazyload('*')]
+
+
+add_fts_table(Post.__table__)
+
+
+class PostHit:
+    """A post rendered from its search index document.
+
+    It has the attributes used by the _post.html template, so search
+    results can be displayed without loading the posts and their
+    authors from the database.
+    """
+    def __init__(self, id, source):
+        self.id = id
+        self.body = source['body']
+        self.timestamp = datetime.fromisoformat(source['timestamp'])
+        self.language = source['language']
+        self.author = AuthorHit(**source['author'])
+
+
+class AuthorHit:
+    def __init__(self, username, avatar_hash):
+        self.username = username
+        self.avatar_hash = avatar_hash
+
+    def avatar(self, size):
+        return avatar_url(self.avatar_hash, size)
+
+
+@db.event.listens_for(Post, 'after_insert')
+def count_post(mapper, connection, post):
+    connection.execute(sa.update(User.__table__).where(
+        User.__table__.c.id == post.user_id).values(
+            num_posts=User.__table__.c.num_posts + 1))
+
+
+@db.event.listens_for(Post, 'after_insert')
+def fan_out_post(mapper, connection, post):
+    connection.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        sa.union_all(
+            sa.select(sa.literal(post.user_id), sa.literal(post.id),
+                      sa.literal(post.timestamp, sa.DateTime)),
+            sa.select(followers.c.follower_id, sa.literal(post.id),
+                      sa.literal(post.timestamp, sa.DateTime))
+            .where(followers.c.followed_id == post.user_id,
+                   followers.c.follower_id != post.user_id))))
+
 
 class Message(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
@@ -312,7 +712,7 @@ class Message(db.Model):
 
     author: so.Mapped[User] = so.relationship(
         foreign_keys='Message.sender_id',
-        back_populates='messages_sent')
+        back_populates='messages_sent', lazy='selectin')
     recipient: so.Mapped[User] = so.relationship(
         foreign_keys='Message.recipient_id',
         back_populates='messages_received')
@@ -322,6 +722,10 @@ class Message(db.Model):
 
 
 class Notification(db.Model):
+    __table_args__ = (sa.UniqueConstraint(
+        'user_id', 'name', name='uq_notification_user_id_name'),)
+    LATEST_VALUE_NAMES = {'unread_message_count', 'task_progress'}
+
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     name: so.Mapped[str] = so.mapped_column(sa.String(128), index=True)
     user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
@@ -334,6 +738,94 @@ class Notification(db.Model):
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'data': self.get_data(),
+            'timestamp': self.timestamp
+        }
+
+    @staticmethod
+    def channel(user_id):
+        return f'notifications:{user_id}'
+
+    @staticmethod
+    def latest_key(user_id):
+        return f'notifications:{user_id}:latest'
+
+    @staticmethod
+    def send(pipe, user_id, notification):
+        """Add the Redis commands that deliver a notification to a pipeline.
+
+        Latest-value notifications are stored in a hash for clients that
+        poll, and all of them are published to the user's channel.
+        """
+        name = notification['name']
+        if name in Notification.LATEST_VALUE_NAMES:
+            pipe.hset(Notification.latest_key(user_id), name, json.dumps(
+                {'data': notification['data'],
+                 'timestamp': notification['timestamp']}))
+            pipe.expire(Notification.latest_key(user_id),
+                        current_app.config['NOTIFICATION_TTL'])
+        pipe.publish(Notification.channel(user_id), json.dumps(notification))
+
+    @staticmethod
+    def upsert(user_id, name, data, timestamp, connection=None):
+        values = {'user_id': user_id, 'name': name,
+                  'payload_json': json.dumps(data), 'timestamp': timestamp}
+        execute = db.session.execute if connection is None else \
+            connection.execute
+        dialect = (connection or db.session.get_bind()).dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            insert = sqlite.insert if dialect == 'sqlite' else \
+                postgresql.insert
+            stmt = insert(Notification).values(**values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['user_id', 'name'],
+                set_={'payload_json': stmt.excluded.payload_json,
+                      'timestamp': stmt.excluded.timestamp})
+        elif dialect in ('mysql', 'mariadb'):
+            stmt = mysql.insert(Notification).values(**values)
+            stmt = stmt.on_duplicate_key_update(
+                payload_json=stmt.inserted.payload_json,
+                timestamp=stmt.inserted.timestamp)
+        else:
+            execute(sa.delete(Notification).where(
+                Notification.user_id == user_id, Notification.name == name),
+                execution_options={'synchronize_session': 'fetch'})
+            stmt = sa.insert(Notification).values(**values)
+        execute(stmt)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def send_notifications(session):
+    if session.in_nested_transaction():
+        return
+    pending = session.info.pop('notifications', None)
+    if not pending:
+        return
+    try:
+        pipe = current_app.redis.pipeline()
+        for user_id, notification in pending:
+            Notification.send(pipe, user_id, notification)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        # latest-value notifications are only kept in Redis, store them
+        # in the database instead; the session cannot be used after commit
+        with db.engine.begin() as connection:
+            for user_id, notification in pending:
+                if notification['name'] in Notification.LATEST_VALUE_NAMES:
+                    Notification.upsert(user_id, notification['name'],
+                                        notification['data'],
+                                        notification['timestamp'],
+                                        connection=connection)
+
+
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def discard_notifications(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop('notifications', None)
+
 
 class Task(db.Model):
     id: so.Mapped[str] = so.mapped_column(sa.String(36), primary_key=True)
@@ -354,3 +846,33 @@ class Task(db.Model):
     def get_progress(self):
         job = self.get_rq_job()
         return job.meta.get('progress', 0) if job is not None else 100
+
+    @staticmethod
+    def get_progress_many(tasks):
+        if not tasks:
+            return []
+        try:
+            jobs = rq.job.Job.fetch_many([task.id for task in tasks],
+                                         connection=current_app.redis)
+        except redis.exceptions.RedisError:
+            jobs = [None] * len(tasks)
+        return [job.meta.get('progress', 0) if job is not None else 100
+                for job in jobs]
+
+
+class Translation(db.Model):
+    __table_args__ = (sa.UniqueConstraint(
+        'text_hash', 'source_language', 'dest_language',
+        name='uq_translation_text_hash_languages'),)
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    text_hash: so.Mapped[str] = so.mapped_column(sa.String(64))
+    source_language: so.Mapped[str] = so.mapped_column(sa.String(5))
+    dest_language: so.Mapped[str] = so.mapped_column(sa.String(5))
+    text: so.Mapped[str] = so.mapped_column(sa.Text)
+    timestamp: so.Mapped[datetime] = so.mapped_column(
+        default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return '<Translation {} {}->{}>'.format(
+            self.text_hash, self.source_language, self.dest_language)
@@ -0,0 +1,83 @@
+import base64
+import json
+from datetime import datetime
+import sqlalchemy as sa
+from flask import abort
+from app import db
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(values, direction):
+    payload = [direction] + [
+        value.isoformat() if isinstance(value, datetime) else value
+        for value in values]
+    return base64.urlsafe_b64encode(
+        json.dumps(payload).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    direction, *values = json.loads(base64.urlsafe_b64decode(padded))
+    if direction not in ('next', 'prev') or len(values) != len(columns):
+        raise ValueError('invalid cursor')
+    for i, column in enumerate(columns):
+        if column.type.python_type is datetime:
+            values[i] = datetime.fromisoformat(values[i])
+    return direction, values
+
+
+def keyset_paginate(query, columns, cursor, per_page, key=None):
+    """Return a page of results without using OFFSET or COUNT.
+
+    Rows are sorted newest first by ``columns``, which must be unique
+    when taken together (for example a timestamp followed by the id).
+    ``key`` extracts the same values from a returned item and defaults
+    to reading the attributes named after the columns.
+    """
+    if key is None:
+        def key(item):
+            return tuple(getattr(item, column.key) for column in columns)
+    direction = 'next'
+    if cursor:
+        try:
+            direction, values = decode_cursor(cursor, columns)
+        except (ValueError, TypeError):
+            abort(400)
+        if direction == 'next':
+            query = query.where(sa.tuple_(*columns) < sa.tuple_(*values))
+        else:
+            query = query.where(sa.tuple_(*columns) > sa.tuple_(*values))
+    if direction == 'next':
+        order = [column.desc() for column in columns]
+    else:
+        order = [column.asc() for column in columns]
+    items = db.session.scalars(
+        query.order_by(None).order_by(*order).limit(per_page + 1)).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if direction == 'prev':
+        items.reverse()
+    if not items:
+        return KeysetPage(items)
+    has_next = has_more if direction == 'next' else True
+    has_prev = bool(cursor) if direction == 'next' else has_more
+    return KeysetPage(
+        items,
+        next_cursor=encode_cursor(key(items[-1]), 'next')
+        if has_next else None,
+        prev_cursor=encode_cursor(key(items[0]), 'prev')
+        if has_prev else None)
@@ -0,0 +1,89 @@
+from datetime import datetime, timezone, timedelta
+import redis
+from flask import current_app
+from app import db, get_task_queue
+
+BUFFER_KEY = 'last-seen'
+SCHEDULED_KEY = 'last-seen:flush-scheduled'
+
+
+def _naive_utc(value):
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _from_timestamp(value):
+    if value is None:
+        return None
+    return datetime.fromtimestamp(float(value), timezone.utc).replace(
+        tzinfo=None)
+
+
+def latest(stored, buffered):
+    stored = _naive_utc(stored)
+    if buffered is None or (stored is not None and stored >= buffered):
+        return stored
+    return buffered
+
+
+def touch(user):
+    """Record that a user was just seen.
+
+    The time is buffered in Redis and written to the database by the
+    flush_last_seen task. When Redis is not available the user row is
+    updated directly, but at most once per flush interval.
+    """
+    now = datetime.now(timezone.utc)
+    interval = current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.hset(BUFFER_KEY, user.id, now.timestamp())
+        pipe.set(SCHEDULED_KEY, 1, nx=True, ex=interval)
+        _, schedule = pipe.execute()
+        if schedule:
+            get_task_queue('flush_last_seen').enqueue_in(
+                timedelta(seconds=interval), 'app.tasks.flush_last_seen')
+    except redis.exceptions.RedisError:
+        last_seen = _naive_utc(user.last_seen)
+        if last_seen is None or last_seen < _naive_utc(now) - timedelta(
+                seconds=interval):
+            user.last_seen = now
+            db.session.commit()
+
+
+def get_buffered(user_id):
+    try:
+        return _from_timestamp(current_app.redis.hget(BUFFER_KEY, user_id))
+    except redis.exceptions.RedisError:
+        return None
+
+
+def get_buffered_many(user_ids):
+    if not user_ids:
+        return {}
+    try:
+        values = current_app.redis.hmget(BUFFER_KEY, user_ids)
+    except redis.exceptions.RedisError:
+        return {}
+    return {user_id: _from_timestamp(value)
+            for user_id, value in zip(user_ids, values) if value is not None}
+
+
+def drain():
+    """Remove and return all buffered last seen times."""
+    pipe = current_app.redis.pipeline()
+    pipe.hgetall(BUFFER_KEY)
+    pipe.delete(BUFFER_KEY)
+    buffered, _ = pipe.execute()
+    return {int(user_id): _from_timestamp(value)
+            for user_id, value in buffered.items()}
+
+
+def restore(buffered):
+    """Put back times that could not be written, unless newer ones exist."""
+    pipe = current_app.redis.pipeline()
+    for user_id, value in buffered.items():
+        pipe.hsetnx(BUFFER_KEY, user_id,
+                    value.replace(tzinfo=timezone.utc).timestamp())
+    pipe.execute()
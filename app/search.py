@@ -1,28 +1,358 @@
+from hashlib import md5
+import json
+import time
 from flask import current_app
+from elasticsearch import ApiError, TransportError
+import redis
+import sqlalchemy as sa
+from app import db, get_task_queue
+
+DEAD_LETTER_KEY = 'search:dead-letter'
+
+
+class SearchBackend:
+    """Search engine interface; asynchronous backends index through the
+    task queue."""
+    asynchronous = False
+
+    def bulk(self, actions, refresh=False):
+        raise NotImplementedError
+
+    def query(self, index, query, fields, offset, limit):
+        """Return the ids, total number of hits and stored sources."""
+        raise NotImplementedError
+
+    def create_index(self, alias, name=None):
+        return alias
+
+    def swap_alias(self, alias, index):
+        pass
+
+
+class ElasticsearchBackend(SearchBackend):
+    asynchronous = True
+
+    def __init__(self, client):
+        self.client = client
+
+    def bulk(self, actions, refresh=False):
+        operations = []
+        for action in actions:
+            meta = {'_index': action['index'], '_id': action['id']}
+            operations.append({action['op']: meta})
+            if action['op'] == 'index':
+                operations.append(action['document'])
+        try:
+            response = self.client.bulk(
+                operations=operations,
+                refresh='wait_for' if refresh else False)
+        except (ApiError, TransportError):
+            current_app.logger.exception('Bulk indexing request failed')
+            return actions
+        if not response['errors']:
+            return []
+        return [action for action, item in zip(actions, response['items'])
+                if 'error' in next(iter(item.values()))]
+
+    def query(self, index, query, fields, offset, limit):
+        search = self.client.search(
+            index=index,
+            query={'multi_match': {'query': query, 'fields': list(fields)}},
+            source_includes=['stored'],
+            from_=offset,
+            size=limit)
+        hits = search['hits']['hits']
+        return ([int(hit['_id']) for hit in hits],
+                search['hits']['total']['value'],
+                [hit.get('_source', {}).get('stored') for hit in hits])
+
+    def create_index(self, alias, name=None):
+        name = name or '{}-{}'.format(alias, int(time.time()))
+        if not self.client.indices.exists(index=name):
+            # stored fields are only returned with hits, never searched
+            self.client.indices.create(index=name, mappings={
+                'properties': {'stored': {'type': 'object',
+                                          'enabled': False}}})
+        return name
+
+    def swap_alias(self, alias, index):
+        actions = [{'add': {'index': index, 'alias': alias}}]
+        old = []
+        if self.client.indices.exists_alias(name=alias):
+            old = [name for name in self.client.indices.get_alias(name=alias)
+                   if name != index]
+            actions = [{'remove': {'index': name, 'alias': alias}}
+                       for name in old] + actions
+        elif self.client.indices.exists(index=alias):
+            # the alias name is taken by a concrete index from before aliases
+            actions.append({'remove_index': {'index': alias}})
+        # the rebuild is written without waiting for refreshes
+        self.client.indices.refresh(index=index)
+        self.client.indices.update_aliases(actions=actions)
+        for name in old:
+            self.client.indices.delete(index=name)
+
+
+class DatabaseBackend(SearchBackend):
+    """Full-text search in ``<index>_fts`` tables, using FTS5 on SQLite
+    and a tsvector column with a GIN index on Postgres."""
+    dialects = ('sqlite', 'postgresql')
+
+    def _dialect(self):
+        return db.engine.dialect.name
+
+    def bulk(self, actions, refresh=False):
+        try:
+            with db.engine.begin() as connection:
+                for action in actions:
+                    self._apply(connection, action)
+        except sa.exc.SQLAlchemyError:
+            current_app.logger.exception('Database indexing failed')
+            return actions
+        return []
+
+    def _apply(self, connection, action):
+        table = '{}_fts'.format(action['index'])
+        if self._dialect() == 'sqlite':
+            connection.execute(sa.text(
+                f'DELETE FROM {table} WHERE rowid = :id'),
+                {'id': action['id']})
+            if action['op'] == 'index':
+                connection.execute(sa.text(
+                    f'INSERT INTO {table} (rowid, content) '
+                    f'VALUES (:id, :content)'),
+                    {'id': action['id'], 'content': _content(action)})
+        elif action['op'] == 'index':
+            connection.execute(sa.text(
+                f'INSERT INTO {table} (id, document) '
+                f"VALUES (:id, to_tsvector('simple', :content)) "
+                f'ON CONFLICT (id) DO UPDATE '
+                f'SET document = excluded.document'),
+                {'id': action['id'], 'content': _content(action)})
+        else:
+            connection.execute(sa.text(
+                f'DELETE FROM {table} WHERE id = :id'), {'id': action['id']})
+
+    def query(self, index, query, fields, offset, limit):
+        table = f'{index}_fts'
+        params = {'limit': limit, 'offset': offset}
+        if self._dialect() == 'sqlite':
+            terms = ['"{}"'.format(term.replace('"', '""'))
+                     for term in query.split()]
+            if not terms:
+                return [], 0, []
+            params['query'] = ' OR '.join(terms)
+            where = f'FROM {table} WHERE {table} MATCH :query'
+            ids_sql = f'SELECT rowid {where} ORDER BY rank'
+        else:
+            params['query'] = query
+            where = (f"FROM {table}, websearch_to_tsquery('simple', :query) "
+                     f'AS query WHERE document @@ query')
+            ids_sql = (f'SELECT id {where} '
+                       f'ORDER BY ts_rank(document, query) DESC')
+        total = db.session.scalar(sa.text(f'SELECT count(*) {where}'), params)
+        ids = db.session.scalars(sa.text(
+            f'{ids_sql} LIMIT :limit OFFSET :offset'), params).all()
+        return ids, total, [None] * len(ids)
+
+
+def _content(action):
+    return ' '.join(str(value) for field, value in action['document'].items()
+                    if field != 'stored' and value is not None)
+
+
+def add_fts_table(table):
+    """Create and drop the full-text table of ``table`` together with it."""
+    statements = {
+        'sqlite': [f'CREATE VIRTUAL TABLE {table.name}_fts '
+                   f'USING fts5(content)'],
+        'postgresql': [
+            f'CREATE TABLE {table.name}_fts '
+            f'(id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)',
+            f'CREATE INDEX ix_{table.name}_fts_document '
+            f'ON {table.name}_fts USING GIN (document)'],
+    }
+    for dialect, ddl in statements.items():
+        for statement in ddl:
+            sa.event.listen(table, 'after_create',
+                            sa.DDL(statement).execute_if(dialect=dialect))
+    sa.event.listen(table, 'before_drop', sa.DDL(
+        f'DROP TABLE IF EXISTS {table.name}_fts').execute_if(
+            dialect=DatabaseBackend.dialects))
+
+
+def get_backend():
+    name = current_app.config['SEARCH_BACKEND'] or (
+        'elasticsearch' if current_app.elasticsearch else 'database')
+    if name == 'elasticsearch' and current_app.elasticsearch:
+        return ElasticsearchBackend(current_app.elasticsearch)
+    if name == 'database' and \
+            db.engine.dialect.name in DatabaseBackend.dialects:
+        return DatabaseBackend()
+    return None
+
+
+def index_action(index, model):
+    document = {field: getattr(model, field)
+                for field in model.__searchable__}
+    if current_app.config['SEARCH_STORE_SOURCE']:
+        document['stored'] = model.search_source()
+    return {'op': 'index', 'index': index, 'id': model.id,
+            'document': document}
+
+
+def delete_action(index, model):
+    return {'op': 'delete', 'index': index, 'id': model.id}
 
 
 def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, document=payload)
+    bulk_index([index_action(index, model)])
 
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    bulk_index([delete_action(index, model)])
+
+
+def _generation_key(index):
+    return f'search:{index}:generation'
+
+
+def _cache_key(index, generation, query, page, per_page):
+    query = ' '.join(query.lower().split())
+    return 'search:{}:{}:{}:{}:{}'.format(
+        index, generation, per_page, page,
+        md5(query.encode('utf-8')).hexdigest())
+
+
+def query_index(index, query, page, per_page, fields=('*',)):
+    """Return the ids, total number of hits and stored sources of a page.
+
+    Results are cached in Redis together with the ids of the following
+    page, so that paging forward does not query the backend again. The
+    cache keys include a generation number that is bumped whenever the
+    index changes.
+    """
+    backend = get_backend()
+    if backend is None:
+        return [], 0, []
+    try:
+        generation = int(current_app.redis.get(_generation_key(index)) or 0)
+        cached = current_app.redis.get(
+            _cache_key(index, generation, query, page, per_page))
+    except redis.exceptions.RedisError:
+        return backend.query(index, query, fields, (page - 1) * per_page,
+                             per_page)
+    if cached is not None:
+        ids, total, sources = json.loads(cached)
+        return ids, total, sources
+    ids, total, sources = backend.query(index, query, fields,
+                                        (page - 1) * per_page, 2 * per_page)
+    pages = {page: (ids[:per_page], sources[:per_page])}
+    if len(ids) > per_page:
+        pages[page + 1] = (ids[per_page:], sources[per_page:])
+    try:
+        pipe = current_app.redis.pipeline()
+        for number, (page_ids, page_sources) in pages.items():
+            pipe.set(_cache_key(index, generation, query, number, per_page),
+                     json.dumps([page_ids, total, page_sources]),
+                     ex=current_app.config['SEARCH_CACHE_TTL'])
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+    return pages[page][0], total, pages[page][1]
+
+
+def invalidate_cache(index):
+    """Make cached results for an index stale after it was written to."""
+    try:
+        current_app.redis.incr(_generation_key(index))
+    except redis.exceptions.RedisError:
+        pass
+
+
+def bulk_index(actions, refresh=True):
+    """Apply index and delete actions in a single batch.
+
+    Returns the actions that failed, so that they can be retried. With
+    ``refresh`` cached results are only invalidated once the changes are
+    searchable, so that a search made meanwhile cannot cache the old
+    results again. Indexes that are not live yet are written without it.
+    """
+    backend = get_backend()
+    if backend is None or not actions:
+        return []
+    failed = backend.bulk(actions, refresh=refresh)
+    for index in {action['index'] for action in actions}:
+        invalidate_cache(index)
+    return failed
+
+
+def _reindex_key(alias):
+    return f'search:{alias}:reindex'
+
+
+def start_reindex(alias, index):
+    """Send changes to ``index`` as well until it replaces the alias."""
+    try:
+        current_app.redis.set(_reindex_key(alias), index)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Changes made while %s is reindexed will '
+                                   'be missing from %s', alias, index)
+
+
+def _with_reindex_copies(actions):
+    """Copy the actions for aliases that are being rebuilt to the new index."""
+    aliases = sorted({action['index'] for action in actions})
+    try:
+        targets = current_app.redis.mget(
+            [_reindex_key(alias) for alias in aliases])
+    except redis.exceptions.RedisError:
+        return actions
+    copies = []
+    for alias, target in zip(aliases, targets):
+        if target is not None and target.decode() != alias:
+            copies += [dict(action, index=target.decode())
+                       for action in actions if action['index'] == alias]
+    return actions + copies
+
+
+def submit_actions(actions):
+    """Index changes in the background, or right away if configured so."""
+    backend = get_backend()
+    if backend is None or not actions:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
-
-
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
-        return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        query={'multi_match': {'query': query, 'fields': ['*']}},
-        from_=(page - 1) * per_page,
-        size=per_page)
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    actions = _with_reindex_copies(actions)
+    if backend.asynchronous and not current_app.config['SEARCH_INDEX_SYNC']:
+        try:
+            get_task_queue('index_documents').enqueue(
+                'app.tasks.index_documents', actions)
+            return
+        except redis.exceptions.RedisError:
+            pass
+    failed = bulk_index(actions)
+    if failed:
+        dead_letter(failed)
+
+
+def dead_letter(actions):
+    try:
+        current_app.redis.lpush(DEAD_LETTER_KEY, *[
+            json.dumps(action, default=str) for action in actions])
+    except redis.exceptions.RedisError:
+        current_app.logger.error('Could not index %d document(s): %s',
+                                 len(actions), actions)
+
+
+def create_index(alias, name=None):
+    """Create a new index that will later replace an alias."""
+    return get_backend().create_index(alias, name)
+
+
+def swap_alias(alias, index):
+    """Atomically point an alias to a new index and drop the old ones."""
+    get_backend().swap_alias(alias, index)
+    invalidate_cache(alias)
+    try:
+        current_app.redis.delete(_reindex_key(alias))
+    except redis.exceptions.RedisError:
+        pass
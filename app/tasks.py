@@ -1,56 +1,199 @@
+from datetime import timedelta
+import gzip
 import json
+import os
 import sys
 import time
+import redis
 import sqlalchemy as sa
-from flask import render_template
+from flask import current_app, render_template, url_for
 from rq import get_current_job
-from app import create_app, db
+from app import db, get_task_queue
 from app.models import User, Post, Task
 from app.email import send_email
+from app import exports, language, presence, search
 
-app = create_app()
-app.app_context().push()
 
+class ProgressReporter:
+    """Report job progress at most once per percent and per interval."""
+    def __init__(self, total=100, min_interval=None):
+        self.job = get_current_job()
+        self.task = None
+        self.total = total
+        self.min_interval = current_app.config['TASK_PROGRESS_INTERVAL'] \
+            if min_interval is None else min_interval
+        self.progress = None
+        self.pending = None
+        self.published_at = 0.0
 
-def _set_task_progress(progress):
-    job = get_current_job()
-    if job:
-        job.meta['progress'] = progress
-        job.save_meta()
-        task = db.session.get(Task, job.get_id())
-        task.user.add_notification('task_progress', {'task_id': job.get_id(),
-                                                     'progress': progress})
+    def update(self, done):
+        """Report that ``done`` out of ``total`` items are processed.
+
+        Progress stops at 99, only ``finish()`` marks the task complete.
+        """
+        self.set(min(100 * done // self.total, 99) if self.total else 99)
+
+    def set(self, progress):
+        if progress == self.progress:
+            self.pending = None
+            return
+        if self.progress is not None and progress < 100 and \
+                time.monotonic() - self.published_at < self.min_interval:
+            self.pending = progress
+            return
+        self.publish(progress)
+
+    def flush(self):
+        """Publish the last value held back by the interval, if any."""
+        if self.pending is not None:
+            self.publish(self.pending)
+
+    def get_task(self):
+        # the route commits the Task only after enqueueing the job, so it
+        # may not be there yet when the job starts
+        if self.task is None and self.job is not None:
+            self.task = db.session.get(Task, self.job.get_id())
+        return self.task
+
+    def finish(self):
+        task = self.get_task()
+        if self.progress != 100 or task is not None and not task.complete:
+            self.publish(100)
+        # also saves what the job added to the session, such as notifications
+        db.session.commit()
+
+    def publish(self, progress):
+        self.progress = progress
+        self.pending = None
+        self.published_at = time.monotonic()
+        if self.get_task() is None:
+            return
+        self.job.meta['progress'] = progress
+        data = {'task_id': self.task.id, 'progress': progress}
+        try:
+            pipe = current_app.redis.pipeline()
+            pipe.hset(self.job.key, 'meta',
+                      self.job.serializer.dumps(self.job.meta))
+            self.task.user.add_notification('task_progress', data,
+                                            pipeline=pipe)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            # sent again, or stored in the database, by the commit below
+            self.task.user.add_notification('task_progress', data)
+        else:
+            if progress < 100:
+                return
         if progress >= 100:
-            task.complete = True
+            self.task.complete = True
         db.session.commit()
 
 
-def export_posts(user_id):
+def _write_posts_export(user, f):
+    """Write the posts of a user to ``f`` as NDJSON, one post per line.
+
+    Rows are streamed in batches with ``yield_per`` on their own
+    connection, so memory use does not grow with the number of posts
+    and the session can commit while the export runs. Yields the
+    number of posts written after each batch.
+    """
+    query = sa.select(Post.body, Post.timestamp).where(
+        Post.user_id == user.id).order_by(Post.timestamp.asc())
+    written = 0
+    with db.engine.connect() as connection:
+        result = connection.execution_options(
+            yield_per=current_app.config['EXPORT_BATCH_SIZE']).execute(
+                query)
+        for rows in result.partitions():
+            for body, timestamp in rows:
+                f.write(json.dumps({'body': body, 'timestamp':
+                                    timestamp.isoformat() + 'Z'}))
+                f.write('\n')
+            written += len(rows)
+            yield written
+
+
+def export_posts(user_id, base_url):
+    progress = ProgressReporter()
+    task_id = progress.job.get_id()
+    path = exports.export_path(task_id)
+    partial = path + '.part'
     try:
         user = db.session.get(User, user_id)
-        _set_task_progress(0)
-        data = []
-        i = 0
-        total_posts = db.session.scalar(sa.select(sa.func.count()).select_from(
-            user.posts.select().subquery()))
-        for post in db.session.scalars(user.posts.select().order_by(
-                Post.timestamp.asc())):
-            data.append({'body': post.body,
-                         'timestamp': post.timestamp.isoformat() + 'Z'})
-            time.sleep(5)
-            i += 1
-            _set_task_progress(100 * i // total_posts)
-
-        send_email(
-            '[Microblog] Your blog posts',
-            sender=app.config['ADMINS'][0], recipients=[user.email],
-            text_body=render_template('email/export_posts.txt', user=user),
-            html_body=render_template('email/export_posts.html', user=user),
-            attachments=[('posts.json', 'application/json',
-                          json.dumps({'posts': data}, indent=4))],
-            sync=True)
+        progress.set(0)
+        progress.total = db.session.scalar(sa.select(
+            sa.func.count()).select_from(user.posts.select().subquery()))
+        os.makedirs(current_app.config['EXPORTS_DIR'], exist_ok=True)
+        with gzip.open(partial, 'wt', encoding='utf-8') as export:
+            for written in _write_posts_export(user, export):
+                progress.update(written)
+        progress.flush()
+        os.replace(partial, path)
+        try:
+            get_task_queue('delete_export').enqueue_in(
+                timedelta(seconds=current_app.config['EXPORT_TTL']),
+                'app.tasks.delete_export', task_id)
+        except redis.exceptions.RedisError:
+            # "flask exports purge" deletes it once it expires
+            current_app.logger.warning('Could not schedule the deletion of '
+                                       'export %s', task_id)
+
+        with current_app.test_request_context(base_url=base_url):
+            url = url_for('main.download_export', task_id=task_id,
+                          _external=True)
+            user.add_notification('export_ready', {'task_id': task_id,
+                                                   'url': url})
+            send_email(
+                '[Microblog] Your blog posts',
+                sender=current_app.config['ADMINS'][0],
+                recipients=[user.email],
+                text_body=render_template('email/export_posts.txt',
+                                          user=user, url=url),
+                html_body=render_template('email/export_posts.html',
+                                          user=user, url=url),
+                sync=True)
     except Exception:
-        _set_task_progress(100)
-        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        current_app.logger.error('Unhandled exception',
+                                 exc_info=sys.exc_info())
+        if os.path.exists(partial):
+            os.remove(partial)
     finally:
-        _set_task_progress(100)
+        progress.finish()
+
+
+def delete_export(task_id):
+    exports.remove(task_id)
+
+
+def flush_last_seen():
+    buffered = presence.drain()
+    if not buffered:
+        return
+    try:
+        db.session.execute(sa.update(User), [
+            {'id': user_id, 'last_seen': last_seen}
+            for user_id, last_seen in buffered.items()])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        presence.restore(buffered)
+        raise
+
+
+def index_documents(actions, attempt=0):
+    failed = search.bulk_index(actions)
+    if not failed:
+        return
+    if attempt < current_app.config['SEARCH_INDEX_RETRIES']:
+        get_task_queue('index_documents').enqueue_in(
+            timedelta(seconds=10 * 2 ** attempt), 'app.tasks.index_documents',
+            failed, attempt + 1)
+    else:
+        search.dead_letter(failed)
+
+
+def detect_post_language(post_id):
+    post = db.session.get(Post, post_id)
+    if post is None or post.language is not None:
+        return
+    post.language = language.detect_language(post.body)
+    db.session.commit()
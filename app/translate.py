@@ -1,21 +1,233 @@
+from hashlib import sha256
+import threading
+import time
 import requests
-from flask import current_app
+from requests.adapters import HTTPAdapter
+import redis
+import sqlalchemy as sa
+from flask import Flask, current_app, request
 from flask_babel import _
+from app import db
+from app.models import Translation
+
+STATS_KEY = 'translation:stats'
+
+
+def _cache_key(text_hash, source_language, dest_language):
+    return f'translation:{source_language}:{dest_language}:{text_hash}'
+
+
+def _count(stat, amount=1):
+    if not amount:
+        return
+    try:
+        current_app.redis.hincrby(STATS_KEY, stat, amount)
+    except redis.exceptions.RedisError:
+        pass
+
+
+def get_cache_stats():
+    """Return the hit and miss counters of the translation cache."""
+    stats = dict.fromkeys(['redis_hits', 'db_hits', 'misses'], 0)
+    try:
+        stats.update({key.decode(): int(value) for key, value in
+                      current_app.redis.hgetall(STATS_KEY).items()})
+    except redis.exceptions.RedisError:
+        pass
+    return stats
+
+
+def _get_cached(text_hashes, source_language, dest_language):
+    """Return a dict with the cached translations of the given hashes."""
+    keys = [_cache_key(text_hash, source_language, dest_language)
+            for text_hash in text_hashes]
+    try:
+        values = current_app.redis.mget(keys)
+    except redis.exceptions.RedisError:
+        values = [None] * len(keys)
+    cached = {text_hash: value.decode('utf-8')
+              for text_hash, value in zip(text_hashes, values)
+              if value is not None}
+    _count('redis_hits', len(cached))
+    missing = [text_hash for text_hash in text_hashes
+               if text_hash not in cached]
+    if not missing or not current_app.config['TRANSLATION_CACHE_DB']:
+        return cached
+    stored = dict(db.session.execute(
+        sa.select(Translation.text_hash, Translation.text).where(
+            Translation.text_hash.in_(missing),
+            Translation.source_language == source_language,
+            Translation.dest_language == dest_language)).all())
+    _count('db_hits', len(stored))
+    _store_redis(stored, source_language, dest_language)
+    cached.update(stored)
+    return cached
+
+
+def _store_redis(translations, source_language, dest_language):
+    if not translations:
+        return
+    try:
+        pipe = current_app.redis.pipeline()
+        for text_hash, text in translations.items():
+            pipe.set(_cache_key(text_hash, source_language, dest_language),
+                     text, ex=current_app.config['TRANSLATION_CACHE_TTL'])
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def _store(translations, source_language, dest_language):
+    _store_redis(translations, source_language, dest_language)
+    if not current_app.config['TRANSLATION_CACHE_DB']:
+        return
+    for text_hash, text in translations.items():
+        try:
+            with db.session.begin_nested():
+                db.session.add(Translation(
+                    text_hash=text_hash, source_language=source_language,
+                    dest_language=dest_language, text=text))
+        except sa.exc.IntegrityError:
+            # another request stored the same translation first
+            pass
+    db.session.commit()
+
+
+class TranslatorClient:
+    """Connection-pooled client for the Translator API.
+
+    Requests have connect and read timeouts. After ``failure_threshold``
+    consecutive failures the circuit opens and calls fail immediately
+    without contacting the service, until ``reset_timeout`` seconds
+    have passed and a trial request is let through again.
+    """
+    def __init__(self, url, key, region, timeout=(3.05, 10),
+                 failure_threshold=5, reset_timeout=30, pool_size=10):
+        self.url = url.rstrip('/') + '/translate'
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Ocp-Apim-Subscription-Key': key,
+            'Ocp-Apim-Subscription-Region': region
+        })
+
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None and \
+                time.monotonic() - self.opened_at < self.reset_timeout
+
+    def _record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+
+    def translate(self, texts, source_language, dest_language):
+        """Return the translations of ``texts``, or None on failure."""
+        if self.is_open():
+            return None
+        try:
+            r = self.session.post(
+                self.url, params={'api-version': '3.0',
+                                  'from': source_language,
+                                  'to': dest_language},
+                json=[{'Text': text} for text in texts],
+                timeout=self.timeout)
+        except requests.RequestException:
+            current_app.logger.warning('Translator request failed',
+                                       exc_info=True)
+            self._record(False)
+            return None
+        if r.status_code != 200:
+            # client errors are not a sign that the service is unhealthy
+            self._record(r.status_code < 500 and r.status_code != 429)
+            return None
+        self._record(True)
+        return [item['translations'][0]['text'] for item in r.json()]
+
+
+def get_client():
+    client = current_app.extensions.get('translator')
+    if client is None:
+        config = current_app.config
+        client = current_app.extensions['translator'] = TranslatorClient(
+            config['MS_TRANSLATOR_URL'], config['MS_TRANSLATOR_KEY'],
+            config['MS_TRANSLATOR_REGION'],
+            timeout=(config['TRANSLATOR_CONNECT_TIMEOUT'],
+                     config['TRANSLATOR_READ_TIMEOUT']),
+            failure_threshold=config['TRANSLATOR_FAILURE_THRESHOLD'],
+            reset_timeout=config['TRANSLATOR_RESET_TIMEOUT'],
+            pool_size=config['TRANSLATOR_POOL_SIZE'])
+    return client
+
+
+def create_stub_app(delay=0.0):
+    """Return an app that stands in for the Translator API.
+
+    It answers like the real service, with each text prefixed by the
+    destination language, after sleeping ``delay`` seconds. It is used
+    by the tests and for benchmarks, by pointing MS_TRANSLATOR_URL at it.
+    """
+    stub = Flask(__name__)
+
+    @stub.route('/translate', methods=['POST'])
+    def stub_translate():
+        time.sleep(delay)
+        dest_language = request.args['to']
+        return [{'translations': [{'text': '[{}] {}'.format(
+            dest_language, item['Text']), 'to': dest_language}]}
+            for item in request.get_json()]
+
+    return stub
+
+
+def translate_many(texts, source_language, dest_language):
+    """Translate a list of texts that are all in the same language.
+
+    Texts that are not cached are sent to the translator together, in
+    requests of up to TRANSLATION_BATCH_SIZE texts.
+    """
+    text_hashes = [sha256(text.encode('utf-8')).hexdigest() for text in texts]
+    cached = _get_cached(list(dict.fromkeys(text_hashes)), source_language,
+                         dest_language)
+    missing = {}
+    for text_hash, text in zip(text_hashes, texts):
+        if text_hash not in cached:
+            missing[text_hash] = text
+    if missing:
+        if 'MS_TRANSLATOR_KEY' not in current_app.config or \
+                not current_app.config['MS_TRANSLATOR_KEY']:
+            error = _('Error: the translation service is not configured.')
+            return [cached.get(text_hash, error) for text_hash in text_hashes]
+        _count('misses', len(missing))
+        missing = list(missing.items())
+        batch_size = current_app.config['TRANSLATION_BATCH_SIZE']
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            results = get_client().translate(
+                [text for text_hash, text in batch],
+                source_language, dest_language)
+            if results is None:
+                continue
+            translations = {text_hash: result for (text_hash, text), result
+                            in zip(batch, results)}
+            _store(translations, source_language, dest_language)
+            cached.update(translations)
+    error = _('Error: the translation service failed.')
+    return [cached.get(text_hash, error) for text_hash in text_hashes]
 
 
 def translate(text, source_language, dest_language):
-    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
-            not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
-    auth = {
-        'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
-        'Ocp-Apim-Subscription-Region': 'westus'
-    }
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[
-                {'Text': text}])
-    if r.status_code != 200:
-        return _('Error: the translation service failed.')
-    return r.json()[0]['translations'][0]['text']
+    return translate_many([text], source_language, dest_language)[0]
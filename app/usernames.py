@@ -0,0 +1,81 @@
+from bisect import bisect_left, insort
+import threading
+import time
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+from app.models import User
+
+
+class UsernameIndex:
+    """Usernames kept sorted in memory for prefix lookups with bisect.
+
+    The index is loaded from the database on first use and reloaded
+    after ``ttl`` seconds, which picks up users that were added or
+    renamed by other worker processes.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.keys = []
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        keys = sorted((username.lower(), username) for username in
+                      db.session.scalars(sa.select(User.username)))
+        with self.lock:
+            self.keys = keys
+            self.loaded_at = time.monotonic()
+
+    def complete(self, prefix, limit=10):
+        if self.loaded_at is None or \
+                time.monotonic() - self.loaded_at > self.ttl:
+            self.load()
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        keys = self.keys
+        start = bisect_left(keys, (prefix,))
+        usernames = []
+        for key, username in keys[start:start + limit]:
+            if not key.startswith(prefix):
+                break
+            usernames.append(username)
+        return usernames
+
+    def add(self, username):
+        if self.loaded_at is None:
+            return
+        with self.lock:
+            insort(self.keys, (username.lower(), username))
+
+    def remove(self, username):
+        if self.loaded_at is None:
+            return
+        key = (username.lower(), username)
+        with self.lock:
+            i = bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+
+
+def get_index():
+    index = current_app.extensions.get('username_index')
+    if index is None:
+        index = current_app.extensions['username_index'] = UsernameIndex(
+            current_app.config['USERNAME_INDEX_TTL'])
+    return index
+
+
+def complete(prefix, limit=10):
+    return get_index().complete(prefix, limit)
+
+
+def add(username):
+    get_index().add(username)
+
+
+def rename(old, new):
+    if old != new:
+        get_index().remove(old)
+        get_index().add(new)
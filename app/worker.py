@@ -0,0 +1,122 @@
+import importlib
+import os
+import signal
+import time
+from flask import current_app, has_app_context
+from redis import Redis
+import rq
+from app import create_app, language
+
+
+def bootstrap():
+    """Load the app, task module and language profiles for forked jobs."""
+    start = time.perf_counter()
+    if has_app_context():
+        app = current_app._get_current_object()
+    else:
+        app = create_app()
+        app.app_context().push()
+    importlib.import_module('app.tasks')
+    language.preload()
+    app.logger.info('Worker bootstrap took %.1f ms',
+                    (time.perf_counter() - start) * 1000)
+    return app
+
+
+class MicroblogWorker(rq.Worker):
+    """rq worker that runs jobs in a preloaded application context."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.app = bootstrap()
+        self.job_started = None
+
+    def execute_job(self, job, queue):
+        self.job_started = time.perf_counter()
+        return super().execute_job(job, queue)
+
+    def perform_job(self, job, queue):
+        overhead = time.perf_counter() - self.job_started
+        result = super().perform_job(job, queue)
+        self.app.logger.info(
+            'Job %s (%s): %.1f ms overhead, %.1f ms total', job.id,
+            job.func_name, overhead * 1000,
+            (time.perf_counter() - self.job_started) * 1000)
+        return result
+
+
+def parse_workers(spec):
+    """Parse a ``queue=count,...`` worker specification into a dict."""
+    workers = {}
+    for item in spec.split(','):
+        name, _, count = item.strip().partition('=')
+        workers[name] = int(count or 1)
+    return workers
+
+
+class WorkerPool:
+    """Run a fixed number of forked rq workers for each queue, restarting
+    them until SIGINT or SIGTERM."""
+    def __init__(self, redis_url, workers, prefix='microblog-',
+                 logger=None):
+        self.redis_url = redis_url
+        self.workers = workers
+        self.prefix = prefix
+        self.logger = logger
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self, name):
+        start = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.work(name, start)
+            os._exit(0)
+        self.children[pid] = name
+        return pid
+
+    def work(self, name, start):
+        connection = Redis.from_url(self.redis_url)
+        worker = MicroblogWorker([rq.Queue(self.prefix + name,
+                                           connection=connection)],
+                                 connection=connection)
+        worker.app.logger.info('Worker for queue %s started in %.1f ms', name,
+                               (time.perf_counter() - start) * 1000)
+        worker.work(with_scheduler=True)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        # load everything once here, so that forked workers share it
+        bootstrap()
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for name, count in self.workers.items():
+            for _ in range(count):
+                self.spawn(name)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            name = self.children.pop(pid, None)
+            if name is not None and not self.stopping:
+                if self.logger:
+                    self.logger.warning('Worker %d for queue %s exited with '
+                                        'code %d, restarting', pid, name,
+                                        os.waitstatus_to_exitcode(status))
+                # avoid a tight loop when workers cannot start
+                time.sleep(1)
+                self.spawn(name)
+
+
+def sleep_task(seconds):
+    """No-op job used by the queue latency benchmark."""
+    time.sleep(seconds)
@@ -20,6 +20,45 @@ class Config:
     ADMINS = ['your-email@example.com']
     LANGUAGES = ['en', 'es']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or \
+        'https://api.cognitive.microsofttranslator.com'
+    MS_TRANSLATOR_REGION = os.environ.get('MS_TRANSLATOR_REGION') or 'westus'
+    TRANSLATOR_CONNECT_TIMEOUT = 3.05
+    TRANSLATOR_READ_TIMEOUT = 10
+    TRANSLATOR_FAILURE_THRESHOLD = 5
+    TRANSLATOR_RESET_TIMEOUT = 30
+    TRANSLATOR_POOL_SIZE = 10
+    TRANSLATION_CACHE_TTL = 7 * 24 * 60 * 60
+    TRANSLATION_CACHE_DB = os.environ.get('TRANSLATION_CACHE_DB') is not None
+    TRANSLATION_BATCH_SIZE = 100
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    SEARCH_INDEX_SYNC = os.environ.get('SEARCH_INDEX_SYNC') is not None
+    SEARCH_INDEX_RETRIES = 3
+    SEARCH_STORE_SOURCE = os.environ.get('SEARCH_STORE_SOURCE') is not None
+    SEARCH_CACHE_TTL = 10 * 60
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    # the first queue is the default for tasks without a route
+    TASK_QUEUES = ['interactive', 'bulk', 'maintenance']
+    TASK_ROUTES = {
+        'export_posts': 'bulk',
+        'flush_last_seen': 'maintenance',
+        'delete_export': 'maintenance',
+    }
+    TASK_WORKERS = os.environ.get('TASK_WORKERS') or \
+        'interactive=2,bulk=1,maintenance=1'
     POSTS_PER_PAGE = 25
+    EXPORT_BATCH_SIZE = 1000
+    EXPORTS_DIR = os.environ.get('EXPORTS_DIR') or \
+        os.path.join(basedir, 'exports')
+    EXPORT_TTL = 7 * 24 * 60 * 60
+    TASK_PROGRESS_INTERVAL = 1.0
+    LAST_SEEN_FLUSH_INTERVAL = int(
+        os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
+    UNREAD_MESSAGE_COUNT_TTL = 24 * 60 * 60
+    USERNAME_INDEX_TTL = 5 * 60
+    NOTIFICATION_TTL = 24 * 60 * 60
+    NOTIFICATION_STREAM = os.environ.get('NOTIFICATION_STREAM') is not None
+    NOTIFICATION_STREAM_TIMEOUT = 60
+    NOTIFICATION_STREAM_KEEPALIVE = 15
+    RAISE_ON_LAZY_LOAD = os.environ.get('RAISE_ON_LAZY_LOAD') is not None
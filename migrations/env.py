@@ -65,6 +65,13 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
+    # the full-text tables of the database search backend are created
+    # with raw DDL and are not part of the models
+    def include_name(name, type_, parent_names):
+        if type_ == 'table':
+            return '_fts' not in name
+        return True
+
     engine = engine_from_config(config.get_section(config.config_ini_section),
                                 prefix='sqlalchemy.',
                                 poolclass=pool.NullPool)
@@ -73,6 +80,7 @@ def run_migrations_online():
     context.configure(connection=connection,
                       target_metadata=target_metadata,
                       process_revision_directives=process_revision_directives,
+                      include_name=include_name,
                       **current_app.extensions['migrate'].configure_args)
 
     try:
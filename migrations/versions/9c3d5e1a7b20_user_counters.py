@@ -0,0 +1,43 @@
+"""user counters
+
+Revision ID: 9c3d5e1a7b20
+Revises: 5a9e2c71d3f4
+Create Date: 2026-10-17 11:40:03.562871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c3d5e1a7b20'
+down_revision = '5a9e2c71d3f4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('num_posts', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('num_followers', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('num_following', sa.Integer(), server_default='0', nullable=False))
+
+    user = sa.table('user', sa.column('id'), sa.column('num_posts'),
+                    sa.column('num_followers'), sa.column('num_following'))
+    post = sa.table('post', sa.column('user_id'))
+    followers = sa.table('followers', sa.column('follower_id'),
+                         sa.column('followed_id'))
+    op.execute(user.update().values(
+        num_posts=sa.select(sa.func.count()).select_from(post).where(
+            post.c.user_id == user.c.id).scalar_subquery(),
+        num_followers=sa.select(sa.func.count()).select_from(followers).where(
+            followers.c.followed_id == user.c.id).scalar_subquery(),
+        num_following=sa.select(sa.func.count()).select_from(followers).where(
+            followers.c.follower_id == user.c.id).scalar_subquery()))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('num_following')
+        batch_op.drop_column('num_followers')
+        batch_op.drop_column('num_posts')
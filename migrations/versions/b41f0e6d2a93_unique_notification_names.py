@@ -0,0 +1,32 @@
+"""unique notification names
+
+Revision ID: b41f0e6d2a93
+Revises: 9c3d5e1a7b20
+Create Date: 2026-10-17 15:02:17.903412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b41f0e6d2a93'
+down_revision = '9c3d5e1a7b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep only the most recent notification of each name for every user
+    op.execute(
+        'DELETE FROM notification WHERE id NOT IN ('
+        'SELECT id FROM (SELECT max(id) AS id FROM notification '
+        'GROUP BY user_id, name) AS latest)')
+
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_notification_user_id_name', ['user_id', 'name'])
+
+
+def downgrade():
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_notification_user_id_name', type_='unique')
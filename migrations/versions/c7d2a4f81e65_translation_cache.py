@@ -0,0 +1,33 @@
+"""translation cache
+
+Revision ID: c7d2a4f81e65
+Revises: b41f0e6d2a93
+Create Date: 2026-10-17 16:40:52.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d2a4f81e65'
+down_revision = 'b41f0e6d2a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('translation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('text_hash', sa.String(length=64), nullable=False),
+    sa.Column('source_language', sa.String(length=5), nullable=False),
+    sa.Column('dest_language', sa.String(length=5), nullable=False),
+    sa.Column('text', sa.Text(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('text_hash', 'source_language', 'dest_language', name='uq_translation_text_hash_languages')
+    )
+
+
+def downgrade():
+    op.drop_table('translation')
@@ -0,0 +1,42 @@
+"""database search
+
+Revision ID: e4a1c9d7b352
+Revises: c7d2a4f81e65
+Create Date: 2026-10-17 19:24:06.511873
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a1c9d7b352'
+down_revision = 'c7d2a4f81e65'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # full-text tables of the database search backend, which is only
+    # available on SQLite and Postgres; existing posts are indexed here
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS post_fts '
+                   'USING fts5(content)')
+        op.execute(
+            'INSERT INTO post_fts (rowid, content) SELECT id, body FROM post '
+            'WHERE id NOT IN (SELECT rowid FROM post_fts)')
+    elif dialect == 'postgresql':
+        op.execute('CREATE TABLE IF NOT EXISTS post_fts '
+                   '(id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)')
+        op.execute(
+            "INSERT INTO post_fts (id, document) "
+            "SELECT id, to_tsvector('simple', body) FROM post "
+            "ON CONFLICT (id) DO NOTHING")
+        op.execute('CREATE INDEX IF NOT EXISTS ix_post_fts_document '
+                   'ON post_fts USING GIN (document)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name in ('sqlite', 'postgresql'):
+        op.execute('DROP TABLE IF EXISTS post_fts')
@@ -1,6 +1,12 @@
+from datetime import datetime
+from hashlib import md5
+import json
 import pytest
-from app import create_app, db
-from app.models import User, Post, Message
+import redis
+import sqlalchemy as sa
+from app import create_app, db, search
+from flask import render_template_string
+from app.models import User, Post, Message, Task, LazyLoadError
 from config import Config
 
 
@@ -10,6 +16,8 @@ class TestConfig(Config):
     WTF_CSRF_ENABLED = False
     TESTING = True
     SERVER_NAME = None
+    RAISE_ON_LAZY_LOAD = True
+    SEARCH_INDEX_SYNC = True
 
 # FIXTURES
 
@@ -28,6 +36,201 @@ def app():
 def client(app):
     return app.test_client()
 
+
+# zastepczy Elasticsearch: zapisuje dokumenty, wyszukiwanie zwraca wszystkie
+class FakeIndices:
+    def __init__(self):
+        self.created, self.aliases, self.refreshed = [], [], []
+
+    def exists(self, index):
+        return index in self.created
+
+    def create(self, index, mappings):
+        self.created.append(index)
+
+    def exists_alias(self, name):
+        return False
+
+    def refresh(self, index):
+        self.refreshed.append(index)
+
+    def update_aliases(self, actions):
+        self.aliases.append(actions)
+
+
+class FakeElasticsearch:
+    def __init__(self):
+        self.indices = FakeIndices()
+        self.documents = {}
+        self.calls = []
+        self.searches = []
+        self.queries = []
+        self.refreshes = []
+        self.fail = lambda id: False
+
+    def bulk(self, operations, refresh=False):
+        self.calls.append(operations)
+        self.refreshes.append(refresh)
+        items = []
+        operations = iter(operations)
+        for meta in operations:
+            op, id = next(iter(meta)), next(iter(meta.values()))['_id']
+            doc = next(operations) if op == 'index' else None
+            if self.fail(id):
+                items.append({op: {'_id': id, 'status': 429, 'error': {
+                    'type': 'too_many_requests'}}})
+                continue
+            if doc is None:
+                self.documents.pop(id, None)
+            else:
+                self.documents[id] = doc
+            items.append({op: {'_id': id, 'status': 200}})
+        return {'errors': any('error' in next(iter(item.values()))
+                              for item in items), 'items': items}
+
+    def search(self, index, query, source_includes, from_, size):
+        self.searches.append((from_, size))
+        self.queries.append(query)
+        hits = [{'_id': str(id), '_source': {'stored': doc['stored']}
+                 if 'stored' in doc else {}}
+                for id, doc in sorted(self.documents.items())]
+        return {'hits': {'hits': hits[from_:from_ + size],
+                         'total': {'value': len(hits)}}}
+
+
+# zastepczy Redis trzymajacy dane w slowniku, potok wykonuje polecenia od razu;
+# polecenia bez implementacji zachowuja sie jak niedostepny serwer
+def _bytes(value):
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.results = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        return lambda *args, **kwargs: self.results.append(
+            method(*args, **kwargs))
+
+    def execute(self):
+        results, self.results = self.results, []
+        return results
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.published = []
+
+    def __getattr__(self, name):
+        raise redis.exceptions.ConnectionError(f'{name} is not supported')
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = _bytes(value)
+        return True
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def incr(self, key):
+        self.data[key] = _bytes(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+    def eval(self, script, numkeys, key):
+        # jedyny skrypt w aplikacji: INCR tylko gdy klucz istnieje
+        return self.incr(key) if key in self.data else None
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[_bytes(field)] = _bytes(value)
+
+    def hgetall(self, key):
+        return self.data.get(key, {})
+
+    def lpush(self, key, *values):
+        self.data[key] = [_bytes(v) for v in reversed(values)] + \
+            self.data.get(key, [])
+        return len(self.data[key])
+
+    def expire(self, key, seconds):
+        pass
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+# zastepcza kolejka zadan: zapisuje zlecone zadania zamiast je wykonywac
+class FakeQueue:
+    def __init__(self):
+        self.jobs = []
+
+    def enqueue(self, func, *args, **kwargs):
+        self.jobs.append((None, func, args))
+
+    def enqueue_in(self, delay, func, *args, **kwargs):
+        self.jobs.append((delay, func, args))
+
+
+# zastepcza odpowiedz uslugi tlumaczen: teksty zamienione na wielkie litery
+class FakeResponse:
+    def __init__(self, status_code, texts):
+        self.status_code = status_code
+        self.texts = texts
+
+    def json(self):
+        return [{'translations': [{'text': t['Text'].upper()}]}
+                for t in self.texts]
+
+
+class FakeTranslator:
+    def __init__(self):
+        self.calls = []
+        self.status_codes = []
+
+    def post(self, url, params, json, timeout):
+        self.calls.append(params)
+        status_code = self.status_codes.pop(0) if self.status_codes else 200
+        return FakeResponse(status_code, json)
+
+
+@pytest.fixture
+def elasticsearch(app):
+    app.elasticsearch = FakeElasticsearch()
+    return app.elasticsearch
+
+
+@pytest.fixture
+def fake_redis(app):
+    app.redis = FakeRedis()
+    return app.redis
+
+
+@pytest.fixture
+def queues(app):
+    app.task_queues = {name: FakeQueue()
+                       for name in app.config['TASK_QUEUES']}
+    return app.task_queues
+
+
+@pytest.fixture
+def translator(app, monkeypatch):
+    fake = FakeTranslator()
+    monkeypatch.setattr('app.translate.requests.Session.post', fake.post)
+    app.config['MS_TRANSLATOR_KEY'] = 'klucz'
+    return fake
+
 #!!!!!!!!!TESTY!!!!!!!!!
 
 # czy poprawne haslo przechodzi weryfikacje po zahashowaniu
@@ -295,4 +498,822 @@ def test_api_error(client, app):
         # proba dostepu bez tokena
         res = client.get('/api/users')
 
-        assert res.status_code == 401
\ No newline at end of file
+        assert res.status_code == 401
+
+# stronicowanie kursorem w API - kolejne strony bez powtorzen i bez licznika
+def test_api_cursor(client, app):
+    with app.app_context():
+        users = [User(username=f"kursor{i}", email=f"kursor{i}@test.com")
+                 for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        token = users[0].get_token()
+        db.session.commit()
+
+    headers = {'Authorization': f'Bearer {token}'}
+    url = '/api/users?cursor=&per_page=2'
+    seen = []
+    while url:
+        res = client.get(url, headers=headers)
+        assert res.status_code == 200
+        assert 'total_items' not in res.json['_meta']
+        seen += [item['username'] for item in res.json['items']]
+        url = res.json['_links']['next']
+    assert seen == [f"kursor{i}" for i in reversed(range(5))]
+
+    res = client.get('/api/users?cursor=zly', headers=headers)
+    assert res.status_code == 400
+
+
+# stronicowanie kursorem na explore - link do starszych wpisow
+def test_explore_cursor(client, app):
+    with app.app_context():
+        app.config['POSTS_PER_PAGE'] = 2
+        u = User(username="kursor", email="kursor@test.com")
+        u.set_password("x")
+        db.session.add(u)
+        db.session.add_all([Post(body=f"wpis{i}", author=u) for i in range(3)])
+        db.session.commit()
+
+    client.post("/auth/login", data={"username": "kursor", "password": "x"})
+    res = client.get("/explore")
+    assert b"wpis2" in res.data and b"wpis0" not in res.data
+    next_url = res.data.decode().split(
+        'Older posts')[0].rsplit('href="', 1)[1].split('"')[0]
+    res = client.get(next_url.replace("&amp;", "&"))
+    assert b"wpis0" in res.data and b"wpis2" not in res.data
+
+
+# liczba zapytan SQL na strone API nie zalezy od liczby uzytkownikow
+def test_api_users_query_count(client, app):
+    with app.app_context():
+        users = [User(username=f"licz{i}", email=f"licz{i}@test.com")
+                 for i in range(6)]
+        db.session.add_all(users)
+        db.session.commit()
+        users[1].follow(users[0])
+        db.session.add(Post(body="wpis", author=users[0]))
+        token = users[0].get_token()
+        db.session.commit()
+        ids = [u.id for u in users]
+
+    headers = {'Authorization': f'Bearer {token}'}
+    queries = []
+
+    def count(*args):
+        queries.append(args[2])
+
+    counts = []
+    with app.app_context():
+        sa.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            for url in ['/api/users?per_page=2', '/api/users?per_page=6',
+                        '/api/users?cursor=&per_page=6',
+                        f'/api/users/{ids[0]}/followers?per_page=6']:
+                queries.clear()
+                res = client.get(url, headers=headers)
+                assert res.status_code == 200
+                counts.append(len(queries))
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', count)
+    assert counts[0] == counts[1] == 3
+    assert counts[2] == 2
+    assert counts[3] == 3
+    assert res.json['items'][0]['_links']['self'] == \
+        f'/api/users/{ids[1]}'
+
+
+# autorzy wpisow ladowani hurtowo, leniwe ladowanie w szablonie rzuca wyjatek
+def test_lazy_load_in_template(client, app):
+    with app.app_context():
+        u = User(username="gosc", email="gosc@test.com")
+        u.set_password("x")
+        authors = [User(username=f"autor{i}", email=f"autor{i}@test.com")
+                   for i in range(3)]
+        db.session.add_all([u] + authors)
+        db.session.add_all([Post(body=f"wpis{i}", author=a)
+                            for i, a in enumerate(authors)])
+        db.session.add(Message(body="czesc", author=authors[0], recipient=u))
+        db.session.commit()
+        message_id = db.session.scalar(sa.select(Message.id))
+
+    client.post("/auth/login", data={"username": "gosc", "password": "x"})
+    assert client.get("/explore").status_code == 200
+    assert client.get("/messages").status_code == 200
+
+    with app.test_request_context():
+        db.session.expunge_all()
+        message = db.session.get(Message, message_id)
+        with pytest.raises(LazyLoadError):
+            render_template_string('{{ m.recipient.username }}', m=message)
+
+
+# bez redisa last_seen zapisywany jest najwyzej raz na interwal
+def test_last_seen_fallback(client, app):
+    with app.app_context():
+        u = User(username="widziany", email="widziany@test.com")
+        u.set_password("x")
+        u.last_seen = datetime(2000, 1, 1)
+        db.session.add(u)
+        db.session.commit()
+
+    client.post("/auth/login", data={"username": "widziany", "password": "x"})
+    client.get("/user/widziany")
+    with app.app_context():
+        u = db.session.scalar(sa.select(User).where(User.username == "widziany"))
+        first = u.last_seen
+        assert first > datetime(2000, 1, 1)
+
+    client.get("/user/widziany")
+    with app.app_context():
+        u = db.session.scalar(sa.select(User).where(User.username == "widziany"))
+        assert u.last_seen == first
+        assert u.get_last_seen() == first
+
+
+# licznik nieprzeczytanych wiadomosci rosnie po wyslaniu i zeruje sie w skrzynce
+def test_unread_message_count(client, app):
+    with app.app_context():
+        s = User(username="nadawca", email="nadawca@test.com")
+        s.set_password("a")
+        r = User(username="odbiorca", email="odbiorca@test.com")
+        r.set_password("b")
+        db.session.add_all([s, r])
+        db.session.commit()
+
+    client.post("/auth/login", data={"username": "nadawca", "password": "a"})
+    client.post("/send_message/odbiorca", data={"message": "raz"})
+    client.post("/send_message/odbiorca", data={"message": "dwa"})
+    with app.app_context():
+        r = db.session.scalar(sa.select(User).where(User.username == "odbiorca"))
+        assert r.unread_message_count() == 2
+
+    client.get("/auth/logout")
+    client.post("/auth/login", data={"username": "odbiorca", "password": "b"})
+    client.get("/messages")
+    with app.app_context():
+        r = db.session.scalar(sa.select(User).where(User.username == "odbiorca"))
+        assert r.unread_message_count() == 0
+
+
+# licznik w redisie zwiekszany dopiero po zapisie wiadomosci, zerowany w skrzynce
+def test_unread_message_count_redis(client, app, fake_redis, monkeypatch):
+    s = User(username="nadawca", email="nadawca@test.com")
+    s.set_password("a")
+    r = User(username="odbiorca", email="odbiorca@test.com")
+    r.set_password("b")
+    db.session.add_all([s, r])
+    db.session.commit()
+    key = f'unread-messages:{r.id}'
+
+    client.post("/auth/login", data={"username": "nadawca", "password": "a"})
+    client.post("/send_message/odbiorca", data={"message": "raz"})
+    assert fake_redis.data[key] == b'1'
+    client.post("/send_message/odbiorca", data={"message": "dwa"})
+    assert fake_redis.data[key] == b'2'
+    assert r.unread_message_count() == 2
+    assert [json.loads(m)['data'] for c, m in fake_redis.published] == [1, 2]
+
+    def failed_commit():
+        raise RuntimeError('zapis nieudany')
+
+    with monkeypatch.context() as m:
+        m.setattr(db.session, 'commit', failed_commit)
+        with pytest.raises(RuntimeError):
+            client.post("/send_message/odbiorca", data={"message": "trzy"})
+    db.session.rollback()
+    assert fake_redis.data[key] == b'2'
+
+    client.get("/auth/logout")
+    client.post("/auth/login", data={"username": "odbiorca", "password": "b"})
+    client.get("/messages")
+    assert fake_redis.data[key] == b'0'
+    assert r.unread_message_count() == 0
+
+
+# postep zadan pobierany raz na zadanie; bez redisa zadanie uznane za skonczone
+def test_tasks_progress(client, app):
+    with app.app_context():
+        u = User(username="eksport", email="eksport@test.com")
+        u.set_password("x")
+        db.session.add(u)
+        db.session.add(Task(id="zadanie-1", name="export_posts",
+                            description="Eksport...", user=u))
+        db.session.commit()
+        with app.test_request_context():
+            assert [(t.id, p) for t, p in u.get_tasks_progress()] == \
+                [("zadanie-1", 100)]
+
+    client.post("/auth/login", data={"username": "eksport", "password": "x"})
+    res = client.get("/user/eksport")
+    assert b'id="zadanie-1-progress">100<' in res.data
+
+
+# strumien powiadomien bez redisa odsyla 204, klient wraca do odpytywania
+def test_notification_stream_fallback(client, app):
+    with app.app_context():
+        u = User(username="strumien", email="strumien@test.com")
+        u.set_password("x")
+        db.session.add(u)
+        db.session.commit()
+
+    client.post("/auth/login", data={"username": "strumien", "password": "x"})
+    assert client.get("/notifications/stream").status_code == 204
+    assert client.get("/notifications?since=0").status_code == 200
+
+
+# powiadomienia tego samego typu nadpisuja sie jednym upsertem
+def test_notification_upsert(client, app):
+    with app.app_context():
+        u = User(username="powiadom", email="powiadom@test.com")
+        u.set_password("x")
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('unread_message_count', 1)
+        db.session.commit()
+        u.add_notification('unread_message_count', 2)
+        db.session.commit()
+        assert db.session.scalar(sa.select(sa.func.count()).select_from(
+            u.notifications.select().subquery())) == 1
+
+    client.post("/auth/login", data={"username": "powiadom", "password": "x"})
+    res = client.get("/notifications?since=0")
+    assert [(n['name'], n['data']) for n in res.json] == \
+        [('unread_message_count', 2)]
+    since = res.json[0]['timestamp']
+    assert client.get(f"/notifications?since={since}").json == []
+
+
+# powiadomienia trafiaja do redisa dopiero po zatwierdzeniu transakcji
+def test_notification_after_commit(app, fake_redis):
+    u = User(username="zatwierdz", email="zatwierdz@test.com")
+    db.session.add(u)
+    db.session.commit()
+
+    u.add_notification('unread_message_count', 1)
+    assert fake_redis.published == []
+    db.session.rollback()
+    db.session.commit()
+    assert fake_redis.published == []
+
+    u.add_notification('unread_message_count', 2)
+    db.session.commit()
+    assert [json.loads(m)['data'] for c, m in fake_redis.published] == [2]
+    assert [n['data'] for n in u.get_notifications()] == [2]
+
+
+# indeksowanie zmian jednym zapytaniem _bulk, bledne dokumenty zwracane do ponowienia
+def test_bulk_index(app, elasticsearch):
+    elasticsearch.fail = lambda id: id % 2 == 0
+    u = User(username="szukaj", email="szukaj@test.com")
+    db.session.add(u)
+    db.session.add_all([Post(body=f"wpis{i}", author=u) for i in range(3)])
+    db.session.commit()
+    assert len(elasticsearch.calls) == 1
+    assert len(elasticsearch.calls[0]) == 6
+
+    posts = db.session.scalars(sa.select(Post).order_by(Post.id)).all()
+    failed = search.bulk_index([search.index_action('post', p) for p in posts])
+    assert [a['id'] for a in failed] == [p.id for p in posts if p.id % 2 == 0]
+
+
+# indeksowanie w tle: ponowienia z rosnacym opoznieniem, potem dead letter
+def test_index_documents_retry(app, elasticsearch, fake_redis, queues):
+    from datetime import timedelta
+    from app import tasks
+
+    app.config['SEARCH_INDEX_SYNC'] = False
+    queue = queues['interactive']
+    u = User(username="kolejka", email="kolejka@test.com")
+    db.session.add(u)
+    db.session.add_all([Post(body=f"wpis{i}", author=u) for i in range(2)])
+    db.session.commit()
+    assert elasticsearch.calls == []
+    jobs = [job for job in queue.jobs
+            if job[1] == 'app.tasks.index_documents']
+    assert len(jobs) == 1 and jobs[0][0] is None
+    actions = jobs[0][2][0]
+    assert [a['document']['body'] for a in actions] == ['wpis0', 'wpis1']
+
+    posts = db.session.scalars(sa.select(Post).order_by(Post.id)).all()
+    elasticsearch.fail = lambda id: id == posts[0].id
+    queue.jobs.clear()
+    tasks.index_documents(actions)
+    assert len(elasticsearch.documents) == 1
+    for attempt in range(1, app.config['SEARCH_INDEX_RETRIES'] + 1):
+        delay, func, (failed, next_attempt) = queue.jobs.pop()
+        assert delay == timedelta(seconds=10 * 2 ** (attempt - 1))
+        assert func == 'app.tasks.index_documents'
+        assert next_attempt == attempt
+        assert [a['id'] for a in failed] == [posts[0].id]
+        tasks.index_documents(failed, next_attempt)
+    assert queue.jobs == []
+    dead = [json.loads(a) for a in fake_redis.data[search.DEAD_LETTER_KEY]]
+    assert [a['id'] for a in dead] == [posts[0].id]
+
+
+# bez kolejki zmiany sa indeksowane od razu, nieudane trafiaja do dead letter
+def test_submit_actions_without_queue(app, elasticsearch, fake_redis):
+    app.config['SEARCH_INDEX_SYNC'] = False
+    # kolejka bez polaczenia: kazde wywolanie konczy sie ConnectionError
+    app.task_queues = {name: FakeRedis() for name in app.config['TASK_QUEUES']}
+    u = User(username="bezkolejki", email="bezkolejki@test.com")
+    db.session.add(u)
+    db.session.commit()
+    elasticsearch.fail = lambda id: True
+    db.session.add(Post(body="wpis", author=u))
+    db.session.commit()
+    assert len(elasticsearch.calls) == 1
+    dead = fake_redis.data[search.DEAD_LETTER_KEY]
+    assert [json.loads(a)['index'] for a in dead] == ['post']
+
+
+# przebudowa indeksu w paczkach do nowego indeksu i podmiana aliasu
+def test_reindex(app, elasticsearch, fake_redis, tmp_path):
+    u = User(username="indeks", email="indeks@test.com")
+    db.session.add(u)
+    db.session.add_all([Post(body=f"wpis{i}", author=u) for i in range(7)])
+    db.session.commit()
+
+    app.instance_path = str(tmp_path)
+    elasticsearch.calls.clear()
+    counts = []
+
+    def progress(count):
+        # wpis usuniety w trakcie przebudowy znika z obu indeksow
+        counts.append(count)
+        if len(counts) == 1:
+            db.session.delete(db.session.scalar(sa.select(Post).where(
+                Post.body == "wpis0")))
+            db.session.commit()
+
+    index = Post.reindex(chunk_size=3, workers=1, callback=progress)
+    assert sorted(counts) == [1, 3, 3]
+    deleted = [op['delete']['_index'] for ops in elasticsearch.calls
+               for op in ops if 'delete' in op]
+    assert sorted(deleted) == sorted(['post', index])
+    assert elasticsearch.indices.aliases == [
+        [{'add': {'index': index, 'alias': 'post'}}]]
+    assert elasticsearch.indices.refreshed == [index]
+    assert elasticsearch.refreshes.count(False) == 3
+    assert list(tmp_path.iterdir()) == []
+    assert 'search:post:reindex' not in fake_redis.data
+
+    # wznowienie z innym rozmiarem paczki zostaje odrzucone
+    (tmp_path / 'reindex-post.json').write_text(json.dumps(
+        {'index': 'post-1', 'chunk_size': 3, 'done': [1]}))
+    with pytest.raises(ValueError):
+        Post.reindex(chunk_size=5, resume=True)
+
+
+# wyszukiwanie pelnotekstowe w bazie danych, gdy Elasticsearch nie jest skonfigurowany
+def test_database_search(app, client):
+    u = User(username="fts", email="fts@test.com")
+    u.set_password("x")
+    db.session.add(u)
+    db.session.add_all([Post(body="ala ma kota", author=u),
+                        Post(body="kot ma ale", author=u),
+                        Post(body="pies i kot, kot i pies", author=u)])
+    db.session.commit()
+
+    posts, total = Post.search("kot", 1, 10)
+    assert total == 2
+    assert [p.body for p in posts] == [
+        "pies i kot, kot i pies", "kot ma ale"]
+
+    post = db.session.scalar(sa.select(Post).where(Post.body == "kot ma ale"))
+    db.session.delete(post)
+    db.session.commit()
+    assert Post.search("kot", 1, 10)[1] == 1
+
+    client.post("/auth/login", data={"username": "fts", "password": "x"})
+    res = client.get("/search?q=kota")
+    assert b"ala ma kota" in res.data
+    assert b"pies i kot" not in res.data
+
+
+# na bazach bez wyszukiwania pelnotekstowego (np. MySQL) wyszukiwanie jest wylaczone
+def test_database_search_unsupported(app, client, monkeypatch):
+    monkeypatch.setattr(db.engine.dialect, 'name', 'mysql')
+    assert search.get_backend() is None
+    u = User(username="mysql", email="mysql@test.com")
+    u.set_password("x")
+    db.session.add(u)
+    db.session.commit()
+
+    client.post("/auth/login", data={"username": "mysql", "password": "x"})
+    res = client.post("/index", data={"post": "ala ma kota"},
+                      follow_redirects=True)
+    assert b"post is now live" in res.data
+    assert Post.search("kota", 1, 10) == ([], 0)
+
+
+# wyniki wyszukiwania w cache razem z nastepna strona, zapis do indeksu uniewaznia cache
+def test_search_cache(app, fake_redis, elasticsearch):
+    elasticsearch.documents = {i: {'body': f'wpis{i}'} for i in range(1, 6)}
+    assert search.query_index('post', 'Ala  ma', 1, 2)[:2] == ([1, 2], 5)
+    assert search.query_index('post', 'ala ma', 2, 2)[:2] == ([3, 4], 5)
+    assert elasticsearch.searches == [(0, 4)]
+
+    u = User(username="cache", email="cache@test.com")
+    db.session.add_all([u, Post(body="ala ma kota", author=u)])
+    db.session.commit()
+    assert elasticsearch.refreshes == ['wait_for']
+    assert search.query_index('post', 'ala ma', 2, 2)[:2] == ([3, 4], 5)
+    assert elasticsearch.searches == [(0, 4), (2, 4)]
+
+
+# wyniki wyszukiwania renderowane z dokumentow w indeksie, bez zapytan do bazy
+def test_search_stored_source(app, client, elasticsearch):
+    app.config['SEARCH_STORE_SOURCE'] = True
+    u = User(username="zrodlo", email="zrodlo@test.com")
+    u.set_password("x")
+    db.session.add_all([u, Post(body="tekst z indeksu", author=u,
+                                language="pl")])
+    db.session.commit()
+    def stored_author():
+        return next(iter(elasticsearch.documents.values()))['stored'][
+            'author']
+
+    assert stored_author() == {'username': 'zrodlo',
+                               'avatar_hash': u.avatar_hash()}
+
+    client.post("/auth/login", data={"username": "zrodlo", "password": "x"})
+    statements = []
+    sa.event.listen(db.engine, 'before_cursor_execute',
+                    lambda *args: statements.append(args[2]))
+    res = client.get("/search?q=tekst")
+    assert b"tekst z indeksu" in res.data
+    assert u.avatar_hash().encode() in res.data
+    assert not [s for s in statements if 'FROM post' in s]
+    assert elasticsearch.queries[-1]['multi_match']['fields'] == ['body']
+
+    # zmiana nazwy lub adresu e-mail autora aktualizuje dokumenty jego wpisow
+    client.post("/edit_profile", data={"username": "nowe", "about_me": ""})
+    assert stored_author() == {'username': 'nowe',
+                               'avatar_hash': u.avatar_hash()}
+    token = u.get_token()
+    db.session.commit()
+    client.put(f"/api/users/{u.id}", json={"email": "nowy@test.com"},
+               headers={"Authorization": f"Bearer {token}"})
+    assert stored_author()['avatar_hash'] == \
+        md5(b"nowy@test.com").hexdigest()
+
+
+# podpowiedzi nazw uzytkownikow po prefiksie, aktualizowane przy rejestracji i zmianie nazwy
+def test_autocomplete_users(app, client):
+    for name in ["adam", "Adrian", "ala", "bartek"]:
+        u = User(username=name, email=f"{name}@test.com")
+        u.set_password("x")
+        db.session.add(u)
+    db.session.commit()
+
+    client.post("/auth/login", data={"username": "ala", "password": "x"})
+    assert client.get("/users/autocomplete?q=AD").json == ["adam", "Adrian"]
+    assert client.get("/users/autocomplete?q=").json == []
+
+    client.post("/edit_profile", data={"username": "adela", "about_me": ""})
+    assert client.get("/users/autocomplete?q=ad").json == [
+        "adam", "adela", "Adrian"]
+    assert client.get("/users/autocomplete?q=al").json == []
+
+
+# tlumaczenia zapisywane w cache, bledy uslugi nie sa zapamietywane
+def test_translation_cache(app, client, translator):
+    translator.status_codes = [500]
+    app.config['TRANSLATION_CACHE_DB'] = True
+    u = User(username="tlumacz", email="tlumacz@test.com")
+    u.set_password("x")
+    db.session.add(u)
+    db.session.commit()
+    client.post("/auth/login", data={"username": "tlumacz", "password": "x"})
+
+    data = {"text": "czesc", "source_language": "pl", "dest_language": "en"}
+    assert client.post("/translate", json=data).json["text"].startswith(
+        "Error")
+    assert client.post("/translate", json=data).json == {"text": "CZESC"}
+    assert client.post("/translate", json=data).json == {"text": "CZESC"}
+    assert len(translator.calls) == 2
+
+
+# tlumaczenie wszystkich wpisow na stronie: jedno zapytanie na jezyk zrodlowy
+def test_translate_posts(app, client, translator):
+    u = User(username="wszystko", email="wszystko@test.com")
+    u.set_password("x")
+    posts = [Post(body="dzien dobry", language="pl", author=u),
+             Post(body="buenos dias", language="es", author=u),
+             Post(body="dobranoc", language="pl", author=u),
+             Post(body="good night", language="en", author=u)]
+    db.session.add_all([u] + posts)
+    db.session.commit()
+    client.post("/auth/login", data={"username": "wszystko", "password": "x"})
+
+    res = client.post("/translate/batch", json={
+        "post_ids": [p.id for p in posts], "dest_language": "en"})
+    assert res.json["translations"] == {
+        str(posts[0].id): "DZIEN DOBRY", str(posts[1].id): "BUENOS DIAS",
+        str(posts[2].id): "DOBRANOC"}
+    assert sorted((p['from'], p['to']) for p in translator.calls) == [
+        ('es', 'en'), ('pl', 'en')]
+
+    # bledne zapytania odrzucane kodem 400
+    for body in [None, [], {"dest_language": "en"},
+                 {"post_ids": ["1"], "dest_language": "en"}]:
+        res = client.post("/translate/batch", json=body)
+        assert res.status_code == 400
+    res = client.post("/translate/batch", data="{",
+                      content_type="application/json")
+    assert res.status_code == 400
+
+
+# klient tlumaczen przez lokalny serwer zastepczy; po bledach obwod sie otwiera
+def test_translator_client(app):
+    from threading import Thread
+    from werkzeug.serving import make_server
+    from app.translate import TranslatorClient, create_stub_app
+
+    server = make_server('127.0.0.1', 0, create_stub_app())
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = TranslatorClient(f'http://127.0.0.1:{server.port}', 'klucz',
+                                  'westus', timeout=(1, 1))
+        assert client.translate(['czesc', 'hej'], 'pl', 'en') == [
+            '[en] czesc', '[en] hej']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    client = TranslatorClient(f'http://127.0.0.1:{server.port}', 'klucz',
+                              'westus', timeout=(0.5, 0.5),
+                              failure_threshold=2)
+    assert client.translate(['czesc'], 'pl', 'en') is None
+    assert not client.is_open()
+    assert client.translate(['czesc'], 'pl', 'en') is None
+    assert client.is_open()
+
+
+# jezyk wpisu wykrywany po zapisie (bez kolejki od razu), zalegle wpisy uzupelnia komenda
+def test_post_language(app, client):
+    u = User(username="jezyk", email="jezyk@test.com")
+    u.set_password("x")
+    db.session.add(u)
+    db.session.add_all([
+        Post(body="Dzisiaj jest bardzo ladna pogoda w Warszawie", author=u),
+        Post(body="The weather is really nice in London today", author=u)])
+    db.session.commit()
+
+    client.post("/auth/login", data={"username": "jezyk", "password": "x"})
+    client.post("/index", data={"post": "Hoy hace muy buen tiempo en Madrid"})
+    post = db.session.scalar(sa.select(Post).where(Post.body.like("Hoy%")))
+    assert post.language == "es"
+
+    res = app.test_cli_runner().invoke(
+        args=["language", "backfill", "--chunk-size", "1", "--workers", "1"])
+    assert "2 posts updated" in res.output
+    assert db.session.scalars(sa.select(Post.language).order_by(
+        Post.id)).all() == ["pl", "en", "es"]
+
+
+# eksport wpisow strumieniowany paczkami do pliku NDJSON skompresowanego gzipem
+def test_write_posts_export(app, tmp_path):
+    import gzip
+    from app.tasks import _write_posts_export
+
+    app.config['EXPORT_BATCH_SIZE'] = 2
+    u = User(username="strumien", email="strumien@test.com")
+    db.session.add_all([u] + [Post(body=f"wpis{i}", author=u,
+                                   timestamp=datetime(2024, 1, 1, 12, i))
+                              for i in range(5)])
+    db.session.commit()
+
+    written = []
+    with gzip.open(tmp_path / "eksport.ndjson.gz", "wt", encoding="utf-8") as f:
+        for count in _write_posts_export(u, f):
+            written.append(count)
+            # zapis postepu zatwierdza sesje miedzy paczkami
+            db.session.commit()
+    assert written == [2, 4, 5]
+
+    with gzip.open(tmp_path / "eksport.ndjson.gz", "rt",
+                   encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    assert lines == [{'body': f"wpis{i}",
+                      'timestamp': f"2024-01-01T12:0{i}:00Z"}
+                     for i in range(5)]
+
+
+# zadanie eksportu konczy sie dopiero po zapisaniu pliku i powiadomienia
+def test_export_posts_task(app, fake_redis, tmp_path, monkeypatch):
+    import os
+    import pickle
+    from app import exports, tasks
+
+    class FakeJob:
+        key = 'rq:job:eksport-1'
+        meta = {}
+        serializer = pickle
+
+        def get_id(self):
+            return 'eksport-1'
+
+    monkeypatch.setattr(tasks, 'get_current_job', FakeJob)
+    app.config['EXPORTS_DIR'] = str(tmp_path)
+    app.config['EXPORT_BATCH_SIZE'] = 2
+    u = User(username="gotowe", email="gotowe@test.com")
+    db.session.add_all([u, Task(id="eksport-1", name="export_posts",
+                                description="", user=u)] +
+                       [Post(body=f"wpis{i}", author=u) for i in range(3)])
+    db.session.commit()
+
+    tasks.export_posts(u.id, 'http://localhost/')
+    published = [json.loads(m) for c, m in fake_redis.published]
+    progress = [n['data']['progress'] for n in published
+                if n['name'] == 'task_progress']
+    assert progress[-1] == 100 and max(progress[:-1]) < 100
+    ready = [n['data'] for n in published if n['name'] == 'export_ready']
+    assert ready == [{'task_id': 'eksport-1',
+                      'url': 'http://localhost/exports/eksport-1'}]
+    assert os.path.exists(exports.export_path('eksport-1'))
+
+    db.session.expire_all()
+    assert db.session.get(Task, 'eksport-1').complete
+    assert 'export_ready' in [n['name'] for n in u.get_notifications()]
+
+
+# pobieranie eksportu: tylko wlasciciel, obsluga Range i ETag, wygasanie plikow
+def test_download_export(app, client, tmp_path):
+    import os
+    from app import exports
+
+    app.config['EXPORTS_DIR'] = str(tmp_path)
+    owner = User(username="eksport", email="eksport@test.com")
+    other = User(username="obcy", email="obcy@test.com")
+    for u in (owner, other):
+        u.set_password("x")
+    db.session.add_all([owner, other, Task(
+        id="abc", name="export_posts", description="", user=owner)])
+    db.session.commit()
+    with open(exports.export_path("abc"), "wb") as f:
+        f.write(b"0123456789")
+
+    client.post("/auth/login", data={"username": "eksport", "password": "x"})
+    res = client.get("/exports/abc", headers={"Range": "bytes=4-"})
+    assert res.status_code == 206
+    assert res.data == b"456789"
+    etag = res.headers["ETag"]
+    assert client.get("/exports/abc", headers={
+        "If-None-Match": etag}).status_code == 304
+
+    os.utime(exports.export_path("abc"), (0, 0))
+    assert client.get("/exports/abc").status_code == 404
+    assert exports.purge() == 1
+
+    client.get("/auth/logout")
+    client.post("/auth/login", data={"username": "obcy", "password": "x"})
+    assert client.get("/exports/abc").status_code == 404
+
+
+# zadania kierowane do kolejek wedlug priorytetu, liczba workerow na kolejke
+def test_task_routing(app):
+    from app import get_task_queue
+    from app.worker import parse_workers
+
+    assert get_task_queue('export_posts').name == 'microblog-bulk'
+    assert get_task_queue('flush_last_seen').name == 'microblog-maintenance'
+    assert get_task_queue('index_documents').name == 'microblog-interactive'
+    assert parse_workers('interactive=3, bulk=1,maintenance') == {
+        'interactive': 3, 'bulk': 1, 'maintenance': 1}
+
+
+# pula forkuje workery, wznawia te ktore padly i przekazuje im SIGTERM
+def test_worker_pool(app, tmp_path):
+    import os
+    import signal
+    import threading
+    import time
+    from app.worker import WorkerPool
+
+    started = tmp_path / 'started'
+
+    class Pool(WorkerPool):
+        def work(self, name, start):
+            with open(started, 'a') as f:
+                f.write(f'{os.getpid()}\n')
+            # pierwszy worker konczy sie bledem, nastepny czeka na sygnal
+            if len(started.read_text().split()) == 1:
+                os._exit(3)
+            signal.pause()
+
+    class Logger:
+        def __init__(self):
+            self.warnings = []
+
+        def warning(self, message, *args):
+            self.warnings.append(message % args)
+
+    def terminate():
+        # SIGTERM dopiero gdy pula zna pid nowego workera
+        while True:
+            pids = started.read_text().split() if started.exists() else []
+            if len(pids) == 2 and list(pool.children) == [int(pids[1])]:
+                break
+            time.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    pool = Pool('redis://', {'bulk': 1}, logger=Logger())
+    handlers = {sig: signal.getsignal(sig)
+                for sig in (signal.SIGINT, signal.SIGTERM)}
+    thread = threading.Thread(target=terminate)
+    thread.start()
+    try:
+        pool.run()
+    finally:
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
+        thread.join()
+    first, second = [int(pid) for pid in started.read_text().split()]
+    assert pool.logger.warnings == [
+        f'Worker {first} for queue bulk exited with code 3, restarting']
+    assert pool.stopping is True and pool.children == {}
+
+
+# postep publikowany najwyzej raz na interwal, wstrzymana wartosc nie ginie
+def test_progress_reporter(app, monkeypatch):
+    from app import tasks
+
+    clock = [0.0]
+    monkeypatch.setattr(tasks.time, 'monotonic', lambda: clock[0])
+    progress = tasks.ProgressReporter(total=100, min_interval=10)
+    published = []
+    publish = progress.publish
+    progress.publish = lambda value: (published.append(value),
+                                      publish(value))
+
+    for done in range(50):
+        progress.update(done)
+    assert published == [0]
+    clock[0] = 11.0
+    progress.update(49)
+    assert published == [0, 49]
+    clock[0] = 12.0
+    progress.update(60)
+    assert published == [0, 49]
+    progress.flush()
+    progress.flush()
+    assert published == [0, 49, 60]
+    progress.finish()
+    progress.finish()
+    assert published == [0, 49, 60, 100]
+
+
+# zadanie zapisane w bazie dopiero po starcie pracy i tak zostaje zakonczone
+def test_progress_reporter_task_committed_late(app, fake_redis, monkeypatch):
+    import pickle
+    from app import tasks
+
+    class FakeJob:
+        key = 'rq:job:pozne-1'
+        meta = {}
+        serializer = pickle
+
+        def get_id(self):
+            return 'pozne-1'
+
+    monkeypatch.setattr(tasks, 'get_current_job', FakeJob)
+    progress = tasks.ProgressReporter(total=10, min_interval=0)
+    progress.set(0)
+    assert fake_redis.published == []
+
+    u = User(username="pozne", email="pozne@test.com")
+    db.session.add_all([u, Task(id="pozne-1", name="export_posts",
+                                description="", user=u)])
+    db.session.commit()
+    progress.update(5)
+    progress.finish()
+    assert db.session.get(Task, "pozne-1").complete is True
+    published = [json.loads(m)['data']['progress']
+                 for c, m in fake_redis.published]
+    assert published == [50, 100]
+
+
+# modul zadan nie tworzy wlasnej aplikacji; postep zapisywany najwyzej raz na procent
+def test_tasks_module(app):
+    from app import tasks, worker
+
+    assert worker.bootstrap() is app
+    progress = tasks.ProgressReporter(total=10000, min_interval=0)
+    published = []
+    progress.publish = lambda value: (published.append(value),
+                                      setattr(progress, 'progress', value))
+    for done in range(10001):
+        progress.update(done)
+    progress.finish()
+    assert published == list(range(101))
+
+    u = User(username="zadanie", email="zadanie@test.com")
+    db.session.add_all([u, Post(body="Guten Morgen, wie geht es dir heute?",
+                                author=u)])
+    db.session.commit()
+    post = db.session.scalar(sa.select(Post))
+    tasks.detect_post_language(post.id)
+    assert post.language == "de"
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from datetime import datetime, timezone, timedelta
 import unittest
+import sqlalchemy as sa
 from app import create_app, db
 from app.models import User, Post
 from config import Config
@@ -10,6 +11,8 @@ class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     ELASTICSEARCH_URL = None
+    RAISE_ON_LAZY_LOAD = True
+    SEARCH_INDEX_SYNC = True
 
 
 class UserModelCase(unittest.TestCase):
@@ -101,6 +104,64 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline_posts(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        now = datetime.now(timezone.utc)
+        p1 = Post(body="post from john", author=u1,
+                  timestamp=now + timedelta(seconds=1))
+        p2 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=3))
+        p3 = Post(body="post from mary", author=u3,
+                  timestamp=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+
+        # posts are fanned out to followers when they are written
+        self.assertTrue(u1.has_timeline())
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(),
+                         [p2, p1])
+
+        # following and unfollowing backfills and trims the timeline
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(),
+                         db.session.scalars(u1.following_posts()).all())
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(),
+                         [p3, p1])
+
+        u1.rebuild_timeline()
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(),
+                         db.session.scalars(u1.following_posts()).all())
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        db.session.add_all([Post(body='one', author=u2),
+                            Post(body='two', author=u2)])
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u2.posts_count(), 2)
+        self.assertEqual(u2.followers_count(), 1)
+        self.assertEqual(u1.following_count(), 1)
+
+        # the stored counters agree with the counts computed from scratch
+        for user in [u1, u2]:
+            for name, query in User.counter_queries().items():
+                self.assertEqual(getattr(user, name), db.session.scalar(
+                    sa.select(query).where(User.id == user.id)))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)